@@ -0,0 +1,157 @@
+"""Batching of index updates.
+
+Within a `searchify.batch()` block, index updates and deletions are collected
+rather than being performed immediately.  When the (outermost) block exits,
+only the latest state of each document is indexed, each instance affected by
+a cascade is indexed once, and the updates are sent in bulk.
+
+"""
+
+import sys
+import threading
+import traceback
+from functools import wraps
+
+from cascade import CascadePlan
+from utils import get_typename_from_object
+
+_local = threading.local()
+
+def get_current_batch():
+    """Get the pending updates of the batch active in this thread, or None.
+
+    """
+    return getattr(_local, 'pending', None)
+
+class PendingUpdates(object):
+    """The updates collected by a batch.
+
+    """
+    def __init__(self):
+        # Map from (typename, docid) to (action, indexer, instance, model key),
+        # where model key is the (typename, pk) of the instance, and the order
+        # in which the keys were first added.
+        self.ops = {}
+        self.order = []
+        # Map from (typename, docid) to (indexer, instance) for the instances
+        # whose cascades need to be followed, and their order.
+        self.cascade_sources = {}
+        self.cascade_order = []
+        # (instance, keys) pairs for the cascades from deleted instances,
+        # which are resolved when they are added.
+        self.resolved_cascades = []
+
+    def _key(self, indexer, instance):
+        return (indexer.get_typename(instance), indexer.get_docid(instance))
+
+    def add(self, action, indexer, instance):
+        """Record that an instance should be indexed or deleted.
+
+        action is 'index' or 'delete'; a later action for the same document
+        replaces an earlier one.
+
+        """
+        key = self._key(indexer, instance)
+        if key not in self.ops:
+            self.order.append(key)
+        self.ops[key] = (action, indexer, instance,
+                         (get_typename_from_object(instance), instance.pk))
+
+    def add_cascade(self, indexer, instance):
+        """Record that the cascade from an instance should be followed.
+
+        The cascade from a deleted instance is resolved immediately, since
+        the instance loses its primary key once the deletion completes.
+
+        """
+        key = self._key(indexer, instance)
+        if key in self.ops and self.ops[key][0] == 'delete':
+            self.resolved_cascades.append(
+                (instance, CascadePlan([]).resolve(instance)))
+            return
+        if key not in self.cascade_sources:
+            self.cascade_order.append(key)
+        self.cascade_sources[key] = (indexer, instance)
+
+    def apply(self):
+        """Perform the collected updates, and flush them.
+
+        """
+        indexers = []
+        def used(indexer):
+            if indexer.index and indexer not in indexers:
+                indexers.append(indexer)
+
+        to_index = {}
+        for key in self.order:
+            (action, indexer, instance, _) = self.ops[key]
+            if action == 'delete':
+                if indexer.index:
+                    indexer.delete_documents([key])
+            else:
+                to_index.setdefault(indexer, []).append(instance)
+            used(indexer)
+        for (indexer, instances) in to_index.iteritems():
+            indexer.index_instances(instances, with_cascade=False, flush=False)
+
+        # Follow the cascades, indexing each target once.  Targets which were
+        # themselves updated or deleted in the batch are already dealt with.
+        done = [model_key for (_, _, _, model_key) in self.ops.itervalues()]
+        plan = CascadePlan([self.cascade_sources[key][1]
+                            for key in self.cascade_order],
+                           exclude=done, resolved=self.resolved_cascades)
+        plan.execute(flush=False)
+        for (indexer, instance) in plan.get_targets():
+            used(indexer)
+
+        for indexer in indexers:
+            indexer.client.flush()
+
+class batch(object):
+    """Collect index updates, and send them in bulk at the end of the batch.
+
+    Use as a context manager:
+
+        with searchify.batch():
+            for obj in objs:
+                obj.save()
+
+    or as a decorator:
+
+        @searchify.batch()
+        def my_view(request):
+            ...
+
+    Batches may be nested; the updates are performed when the outermost batch
+    exits.  Batches are per-thread.
+
+    """
+    def __enter__(self):
+        if get_current_batch() is None:
+            _local.pending = PendingUpdates()
+            _local.depth = 0
+        _local.depth += 1
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        _local.depth -= 1
+        if _local.depth:
+            return False
+        pending = _local.pending
+        _local.pending = None
+        try:
+            pending.apply()
+        except Exception:
+            if exc_type is None:
+                raise
+            # Don't hide the exception raised within the block.
+            print >>sys.stderr, "Error applying batched index updates:"
+            traceback.print_exc()
+        return False
+
+    def __call__(self, func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with self:
+                return func(*args, **kwargs)
+        return wrapper
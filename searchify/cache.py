@@ -0,0 +1,261 @@
+"""Caching of search results.
+
+If `settings.SEARCHIFY_RESULT_CACHE` is set, the responses to searches are
+cached.  The setting may be:
+
+ - 'memory': responses are kept in a per-process LRU cache, holding
+   `settings.SEARCHIFY_RESULT_CACHE_SIZE` entries (default 1000).
+
+ - 'django': responses are kept in Django's cache, shared by all processes.
+
+ - the dotted path of a subclass of ResultCache.
+
+Entries expire after `settings.SEARCHIFY_RESULT_CACHE_TIMEOUT` seconds
+(default 300).
+
+Each index has a generation number, which is part of the key of every entry
+for the index.  The generation is incremented once updates to the index have
+been sent to the search engine, and when a rebuild of the index goes live, so
+that later searches don't see stale results.  For the 'memory' cache, the
+generations are also per-process, so updates made by other processes are only
+seen once the entries expire.
+
+Updates only become searchable once the search engine refreshes the index, so
+after an index changes, its responses aren't cached for
+`settings.SEARCHIFY_RESULT_CACHE_REFRESH` seconds (default 1, elasticsearch's
+default refresh interval); otherwise a response from before the refresh could
+be cached under the new generation.
+
+"""
+
+import hashlib
+import json
+import math
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils.importlib import import_module
+
+# How long generations are kept in Django's cache (the longest timeout
+# memcached accepts).
+GENERATION_TIMEOUT = 30 * 24 * 60 * 60
+
+class ResultCache(object):
+    """Base class for result caches.
+
+    """
+    def __init__(self, timeout=300, refresh=1):
+        self.timeout = timeout
+        self.refresh = refresh
+
+    def make_key(self, index, query):
+        """Make the key for a search of an index, or return None if the
+        response shouldn't be cached, because the index changed too recently.
+
+        query is a JSON-serialisable description of the search (including the
+        index names, doc types and parameters).
+
+        """
+        changed_until = self.get_changed_until(index)
+        if changed_until is not None and changed_until > time.time():
+            return None
+        data = json.dumps(query, cls=DjangoJSONEncoder, sort_keys=True)
+        return 'searchify:%s:%s:%s' % (
+            index, self.get_generation(index),
+            hashlib.md5(data.encode('utf-8')).hexdigest())
+
+    def get(self, key):
+        """Get a cached response, or None if it isn't cached.
+
+        """
+        raise NotImplementedError("Subclasses should implement this")
+
+    def set(self, key, response):
+        """Cache a response.
+
+        """
+        raise NotImplementedError("Subclasses should implement this")
+
+    def get_generation(self, index):
+        """Get the current generation of an index.
+
+        """
+        raise NotImplementedError("Subclasses should implement this")
+
+    def bump_generation(self, index):
+        """Increment the generation of an index, so that the entries cached
+        for it are no longer used.
+
+        """
+        raise NotImplementedError("Subclasses should implement this")
+
+    def get_changed_until(self, index):
+        """Get the time until which the responses for an index aren't cached,
+        or None.
+
+        """
+        raise NotImplementedError("Subclasses should implement this")
+
+    def set_changed_until(self, index, until):
+        """Set the time until which the responses for an index aren't
+        cached.
+
+        """
+        raise NotImplementedError("Subclasses should implement this")
+
+    def index_changed(self, index):
+        """Note that updates to an index have been sent: bump its generation,
+        and stop caching its responses until the updates are searchable.
+
+        """
+        if self.refresh:
+            self.set_changed_until(index, time.time() + self.refresh)
+        self.bump_generation(index)
+
+class MemoryResultCache(ResultCache):
+    """A cache holding the most recently used responses in memory.
+
+    """
+    def __init__(self, timeout=300, refresh=1, size=1000):
+        super(MemoryResultCache, self).__init__(timeout, refresh)
+        self.size = size
+        self._lock = threading.Lock()
+        # Map from key to (response, expiry time).
+        self._items = OrderedDict()
+        self._generations = {}
+        self._changed_until = {}
+
+    def get(self, key):
+        self._lock.acquire()
+        try:
+            item = self._items.pop(key, None)
+            if item is None or item[1] < time.time():
+                return None
+            self._items[key] = item
+            return item[0]
+        finally:
+            self._lock.release()
+
+    def set(self, key, response):
+        self._lock.acquire()
+        try:
+            self._items.pop(key, None)
+            self._items[key] = (response, time.time() + self.timeout)
+            while len(self._items) > self.size:
+                self._items.popitem(last=False)
+        finally:
+            self._lock.release()
+
+    def get_generation(self, index):
+        return self._generations.get(index, 0)
+
+    def bump_generation(self, index):
+        self._lock.acquire()
+        try:
+            self._generations[index] = self._generations.get(index, 0) + 1
+        finally:
+            self._lock.release()
+
+    def get_changed_until(self, index):
+        return self._changed_until.get(index)
+
+    def set_changed_until(self, index, until):
+        self._changed_until[index] = until
+
+class DjangoResultCache(ResultCache):
+    """A cache holding responses in Django's cache.
+
+    The generations are also held in Django's cache.  A generation which is
+    missing (eg: because it was evicted) is started again from the current
+    time, so that it can't return to a value used by older entries.
+
+    """
+    def _generation_key(self, index):
+        return 'searchify:generation:%s' % index
+
+    def _changed_key(self, index):
+        return 'searchify:changed:%s' % index
+
+    def get(self, key):
+        from django.core.cache import cache
+        return cache.get(key)
+
+    def set(self, key, response):
+        from django.core.cache import cache
+        cache.set(key, response, self.timeout)
+
+    def get_generation(self, index):
+        from django.core.cache import cache
+        key = self._generation_key(index)
+        generation = cache.get(key)
+        if generation is None:
+            cache.add(key, int(time.time() * 1000), GENERATION_TIMEOUT)
+            generation = cache.get(key, 0)
+        return generation
+
+    def bump_generation(self, index):
+        from django.core.cache import cache
+        key = self._generation_key(index)
+        try:
+            cache.incr(key)
+        except ValueError:
+            cache.set(key, int(time.time() * 1000), GENERATION_TIMEOUT)
+
+    def get_changed_until(self, index):
+        from django.core.cache import cache
+        return cache.get(self._changed_key(index))
+
+    def set_changed_until(self, index, until):
+        from django.core.cache import cache
+        cache.set(self._changed_key(index), until,
+                  int(math.ceil(until - time.time())) + 1)
+
+_cache = None
+def get_result_cache():
+    """Get the configured result cache, or None if results aren't being
+    cached.
+
+    """
+    global _cache
+    if _cache is None:
+        name = getattr(settings, 'SEARCHIFY_RESULT_CACHE', None)
+        if name is None:
+            return None
+        timeout = getattr(settings, 'SEARCHIFY_RESULT_CACHE_TIMEOUT', 300)
+        refresh = getattr(settings, 'SEARCHIFY_RESULT_CACHE_REFRESH', 1)
+        if name == 'memory':
+            _cache = MemoryResultCache(timeout, refresh,
+                getattr(settings, 'SEARCHIFY_RESULT_CACHE_SIZE', 1000))
+        elif name == 'django':
+            _cache = DjangoResultCache(timeout, refresh)
+        else:
+            try:
+                (module, classname) = name.rsplit('.', 1)
+                _cache = getattr(import_module(module), classname)(timeout,
+                                                                   refresh)
+            except (ValueError, ImportError, AttributeError), e:
+                raise ImproperlyConfigured(
+                    "Could not load SEARCHIFY_RESULT_CACHE %r: %s" % (name, e))
+    return _cache
+
+def bump_generation(index):
+    """Invalidate the cached results for an index, if results are being
+    cached.
+
+    """
+    cache = get_result_cache()
+    if cache is not None:
+        cache.bump_generation(index)
+
+def index_changed(index):
+    """Invalidate the cached results for an index once updates to it have
+    been sent (see ResultCache.index_changed()), if results are being cached.
+
+    """
+    cache = get_result_cache()
+    if cache is not None:
+        cache.index_changed(index)
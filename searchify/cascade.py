@@ -0,0 +1,189 @@
+"""Planning of cascades.
+
+When an instance changes, the index must be updated for the instances which
+depend on it (as listed in the `cascades` of its indexer).  A CascadePlan
+works out the full set of instances affected by changes to one or more
+instances, identifying each by (typename, pk) so that each is indexed once.
+
+Descriptors naming a foreign key are resolved from the key's value, without
+loading the related instance; descriptors returning related managers or
+querysets are resolved with a single query for their primary keys.  The
+affected instances are then loaded with one query per model.
+
+By default only the direct cascades of the changed instances are followed.
+`settings.SEARCHIFY_CASCADE_DEPTH` may be set to follow the cascades of the
+instances cascaded to as well, to that depth (or None for no limit).  Each
+instance is visited at most once, so circular cascades terminate; the edges
+which lead back to an instance earlier in the same chain of cascades are
+recorded in `cycles`.
+
+"""
+
+from django.conf import settings
+from django.core.exceptions import ObjectDoesNotExist
+from django.db import models
+
+from utils import get_indexer, get_typename_from_object, lookup_model
+
+class CascadePlan(object):
+    """The instances which need to be reindexed due to changes to some others.
+
+    """
+    def __init__(self, instances, exclude=(), resolved=(), max_depth=-1):
+        """Plan the cascade from a list of changed instances.
+
+        exclude is a sequence of (typename, pk) pairs which should not be
+        reindexed (eg: because they are being dealt with already).  The
+        changed instances themselves are also never reindexed by the plan.
+
+        resolved is a sequence of (source instance, key list) pairs for
+        changed instances whose cascades have already been resolved (see
+        resolve()); this is needed for deleted instances, whose cascades must
+        be resolved before they lose their primary key.
+
+        """
+        if max_depth == -1:
+            max_depth = getattr(settings, 'SEARCHIFY_CASCADE_DEPTH', 1)
+        self.max_depth = max_depth
+        self.cycles = []
+        self._targets = None
+
+        self._visited = set(exclude)
+        for instance in instances:
+            self._visited.add(self._key(instance))
+        self._sources = list(instances)
+        self._resolved = list(resolved)
+        # Map from key to the key of the instance it was cascaded from.
+        self._parents = {}
+
+    def _key(self, instance):
+        return (get_typename_from_object(instance), instance.pk)
+
+    def _is_ancestor(self, key, source_key):
+        while source_key is not None:
+            if source_key == key:
+                return True
+            source_key = self._parents.get(source_key)
+        return False
+
+    def resolve(self, instance):
+        """Resolve the cascade descriptors for an instance.
+
+        Returns a list of (typename, pk) pairs for the instances depended on,
+        without loading them where possible.
+
+        """
+        return list(self._resolve(instance))
+
+    def _resolve(self, instance):
+        indexer = get_indexer(instance)
+        if indexer is None:
+            return
+        for descriptor in indexer.cascades:
+            if isinstance(descriptor, str):
+                try:
+                    field = instance._meta.get_field(descriptor)
+                except models.FieldDoesNotExist:
+                    field = None
+                if isinstance(field, models.ForeignKey) and \
+                        field.rel.field_name == field.rel.to._meta.pk.name:
+                    pk = getattr(instance, field.attname)
+                    if pk is not None:
+                        yield (get_typename_from_object(field.rel.to), pk)
+                    continue
+            try:
+                if callable(descriptor):
+                    value = descriptor(instance)
+                else:
+                    value = getattr(instance, descriptor)
+            except ObjectDoesNotExist:
+                continue
+            if value is None:
+                continue
+            if isinstance(value, models.Model):
+                yield self._key(value)
+            elif isinstance(value, (models.Manager, models.query.QuerySet)):
+                typename = get_typename_from_object(value.model)
+                for pk in value.values_list('pk', flat=True):
+                    yield (typename, pk)
+            else:
+                for item in value:
+                    yield self._key(item)
+
+    def _load(self, found):
+        """Load the instances found, with one query per model.
+
+        found maps (typename, pk) to the instance the cascade came from.
+        Returns a list of (indexer, instance, source instance) tuples for the
+        instances which exist, have an indexer and accept the cascade.
+
+        """
+        by_model = {}
+        for (typename, pk) in found:
+            by_model.setdefault(typename, []).append(pk)
+        loaded = []
+        for (typename, pks) in by_model.iteritems():
+            indexer = get_indexer(lookup_model(typename))
+            if indexer is None:
+                continue
+            instances = indexer.get_queryset().in_bulk(pks)
+            for pk in pks:
+                instance = instances.get(pk)
+                if instance is None:
+                    continue
+                source = found[(typename, pk)]
+                if indexer.reindex_on_cascade(source, instance):
+                    loaded.append((indexer, instance, source))
+        return loaded
+
+    def get_targets(self):
+        """Get the instances which need to be reindexed.
+
+        Returns a list of (indexer, instance) pairs.
+
+        """
+        if self._targets is not None:
+            return self._targets
+        self._targets = []
+        sources = [(source, self._resolve(source)) for source in self._sources]
+        sources.extend(self._resolved)
+        depth = 0
+        while sources and (self.max_depth is None or depth < self.max_depth):
+            found = {}
+            for (source, keys) in sources:
+                source_key = self._key(source)
+                for key in keys:
+                    if key in self._visited:
+                        if self._is_ancestor(key, source_key):
+                            self.cycles.append((source_key, key))
+                        continue
+                    self._visited.add(key)
+                    self._parents[key] = source_key
+                    found[key] = source
+            loaded = self._load(found)
+            self._targets.extend((indexer, instance)
+                                 for (indexer, instance, _) in loaded)
+            sources = [(instance, self._resolve(instance))
+                       for (_, instance, _) in loaded]
+            depth += 1
+        return self._targets
+
+    def execute(self, flush=True):
+        """Reindex the instances affected by the cascade.
+
+        If flush is True, each client used is flushed once afterwards.
+
+        """
+        indexers = []
+        by_indexer = {}
+        for (indexer, instance) in self.get_targets():
+            if indexer not in by_indexer:
+                indexers.append(indexer)
+            by_indexer.setdefault(indexer, []).append(instance)
+        for indexer in indexers:
+            indexer.index_instances(by_indexer[indexer], with_cascade=False,
+                                    flush=False)
+        if flush:
+            for indexer in indexers:
+                if indexer.index:
+                    indexer.client.flush(force=False)
@@ -0,0 +1,131 @@
+"""Checkpoints recording the progress of a reindex, so that a rebuild which
+fails part way through can be resumed.
+
+A checkpoint is stored in a file (one per index) in the directory given by
+`settings.SEARCHIFY_CHECKPOINT_DIR`, which defaults to the system temporary
+directory.  It records the suffix of the index being built, and for each model
+which has been started, the ranges of primary keys which remain to be indexed.
+
+"""
+
+import json
+import os
+import tempfile
+
+from django.conf import settings
+
+class Checkpoint(object):
+    """The progress of a rebuild of a single index.
+
+    Ranges of primary keys are stored as (after_pk, upto_pk) pairs, as used by
+    Indexer.index_all().  As a range is indexed, its after_pk is advanced; once
+    it has been completely indexed it is removed.  A model with no ranges left
+    has been completely indexed.
+
+    """
+    def __init__(self, indexname, suffix):
+        self.indexname = indexname
+        self.suffix = suffix
+        # Whether the suffixed index has been created yet.
+        self.created = False
+        # Map from typename to list of [after_pk, upto_pk] ranges remaining.
+        self.models = {}
+
+    @staticmethod
+    def get_path(indexname):
+        """Get the path of the checkpoint file for an index.
+
+        """
+        checkpoint_dir = getattr(settings, 'SEARCHIFY_CHECKPOINT_DIR',
+                                 tempfile.gettempdir())
+        return os.path.join(checkpoint_dir,
+                            'searchify_reindex_%s.json' % indexname)
+
+    @classmethod
+    def load(cls, indexname):
+        """Load the checkpoint for an index.
+
+        Returns None if there is no checkpoint stored for the index.
+
+        """
+        try:
+            fd = open(cls.get_path(indexname))
+        except IOError:
+            return None
+        try:
+            data = json.load(fd)
+        finally:
+            fd.close()
+        checkpoint = cls(indexname, data['suffix'])
+        checkpoint.created = data['created']
+        checkpoint.models = data['models']
+        return checkpoint
+
+    def save(self):
+        """Store the checkpoint.
+
+        The file is replaced atomically, so a crash while saving leaves the
+        previous checkpoint intact.
+
+        """
+        path = self.get_path(self.indexname)
+        tmppath = path + '.tmp'
+        fd = open(tmppath, 'w')
+        try:
+            json.dump(dict(suffix=self.suffix, created=self.created,
+                           models=self.models), fd)
+        finally:
+            fd.close()
+        os.rename(tmppath, path)
+
+    def delete(self):
+        """Remove the stored checkpoint, if any.
+
+        """
+        try:
+            os.unlink(self.get_path(self.indexname))
+        except OSError:
+            pass
+
+    def set_created(self):
+        """Record that the suffixed index has been created.
+
+        """
+        self.created = True
+        self.save()
+
+    def get_ranges(self, typename):
+        """Get the ranges remaining to be indexed for a model.
+
+        Returns None if the model hasn't been started.
+
+        """
+        ranges = self.models.get(typename)
+        if ranges is None:
+            return None
+        return [tuple(r) for r in ranges]
+
+    def set_ranges(self, typename, ranges):
+        """Set the ranges which need to be indexed for a model.
+
+        """
+        self.models[typename] = [list(r) for r in ranges]
+        self.save()
+
+    def advance(self, typename, upto_pk, after_pk):
+        """Record that the range ending at upto_pk has been indexed as far as
+        after_pk.
+
+        """
+        for r in self.models[typename]:
+            if r[1] == upto_pk:
+                r[0] = after_pk
+        self.save()
+
+    def complete(self, typename, upto_pk):
+        """Record that the range ending at upto_pk has been completely indexed.
+
+        """
+        self.models[typename] = [r for r in self.models[typename]
+                                 if r[1] != upto_pk]
+        self.save()
@@ -19,12 +19,29 @@ def import_client(engine):
     return mod.Client
 
 
-if hasattr(settings, 'ENABLE_SEARCHIFY') and settings.ENABLE_SEARCHIFY:
-    engine = getattr(settings, "SEARCHIFY_ENGINE", None)
-    if engine is None:
-        raise ImproperlyConfigured('No engine configured for searchify: '
-                                   'specify settings.SEARCHIFY_ENGINE')
-
-    Client = import_client(engine)
-else:
-    Client = import_client('unconfigured')
+_client_class = None
+def get_client_class():
+    """Get the client class for the configured engine.
+
+    The client module (and the search engine's library) is only imported
+    when this is first called.
+
+    """
+    global _client_class
+    if _client_class is None:
+        if hasattr(settings, 'ENABLE_SEARCHIFY') and settings.ENABLE_SEARCHIFY:
+            engine = getattr(settings, "SEARCHIFY_ENGINE", None)
+            if engine is None:
+                raise ImproperlyConfigured('No engine configured for searchify: '
+                                           'specify settings.SEARCHIFY_ENGINE')
+            _client_class = import_client(engine)
+        else:
+            _client_class = import_client('unconfigured')
+    return _client_class
+
+
+def Client():
+    """Create a client for the configured engine.
+
+    """
+    return get_client_class()()
@@ -3,29 +3,575 @@
 To enable this client in the django config, set SEARCHIFY_ENGINE to 'pyes', and
 set ENABLE_SEARCHIFY to True.
 
-This client uses two settings from the django config:
+This client uses these settings from the django config:
 
- - `PYES_ADDRESS` (required, a string): The address to contact to talk to
-   elasticsearch.  Typically, this will be of the form 'hostname:port';
+ - `PYES_ADDRESS` (a string or a list of strings): The address to contact to
+   talk to elasticsearch, or a list of the addresses of several nodes of the
+   cluster.  Typically, each address will be of the form 'hostname:port';
    elasticsearch usually listens on port 9200 for the HTTP transport, or on
    port 9500 for the thrift transport.
 
+ - `PYES_READ_ADDRESSES` (optional, a string or a list of strings, defaults to
+   `PYES_ADDRESS`): The addresses to send searches to.
+
+ - `PYES_WRITE_ADDRESSES` (optional, a string or a list of strings, defaults
+   to `PYES_ADDRESS`): The addresses to send updates (and all other requests
+   apart from searches) to.  Setting this and `PYES_READ_ADDRESSES` to
+   different nodes keeps heavy indexing (eg: a reindex) from slowing down
+   searches.
+
+ - `PYES_TIEBREAK_FIELD` (optional, a string, defaults to "_uid"): A field
+   with a unique, unanalyzed value for each document, which is added to sort
+   orders so that they are total, and which cursors filter on (see
+   `PyesSearchQS.order_by()` and `PyesSearchQS.after()`).
+
  - `PYES_PERSONAL_PREFIX` (optional, a string, defaults to ""). A prefix which
    will be added to all indexnames used.  This can be used to allow multiple
    users to use the same elasticsearch cluster without interfering with each
    other - this is particularly useful in development environments where you
    don't wish to require all users to run an elasticsearch server.
 
+Requests are spread across the nodes (for reading or writing) in turn.  A node
+which can't be connected to is marked as dead, and the request is retried on
+another node; dead nodes are checked in the background, and used again once
+they respond.  Other failures (eg: a request timing out) are raised, and
+aren't retried, since the request may have been carried out, except that
+searches which time out are retried on another node; a node is only marked as
+dead after several such failures in a row.  This is controlled by these
+optional settings:
+
+ - `PYES_TIMEOUT` (a number of seconds, defaults to 30): The timeout for
+   requests other than bulk updates.
+
+ - `PYES_BULK_TIMEOUT` (a number of seconds, defaults to `PYES_TIMEOUT`): The
+   timeout for bulk update requests.
+
+ - `PYES_CONNECT_TIMEOUT` (a number of seconds, defaults to 5): The timeout
+   for connecting to a node before making requests to it, and for a dead node
+   to respond when checking whether it has recovered.
+
+ - `PYES_RETRY_INTERVAL` (a number of seconds, defaults to 30): The interval
+   at which dead nodes are checked.
+
+ - `PYES_MAX_FAILURES` (an integer, defaults to 3): The number of failed
+   requests in a row (other than failures to connect) after which a node is
+   marked as dead.
+
+Updates are buffered, and sent to elasticsearch in bulk requests.  The buffer
+is controlled by these optional settings:
+
+ - `PYES_BULK_SIZE` (an integer, defaults to 400): The number of documents to
+   buffer before sending them.
+
+ - `PYES_BULK_BYTES` (an integer, defaults to 5MB): The size of the buffered
+   requests, in bytes, at which to send them.
+
+ - `PYES_BULK_FLUSH_INTERVAL` (a number of seconds, defaults to None): If set,
+   a background thread sends the buffer at this interval, and updates made for
+   individual instances (eg: when a model instance is saved) are left in the
+   buffer rather than being sent immediately.
+
+The `_async` methods (eg: `PyesSearchQS.execute_async()`) hand requests to a
+shared pool of threads, each with its own connections to the nodes, so that
+the calling thread can do other work (eg: start several searches, or load
+data from the database) while they are in progress.  They return a
+`multiprocessing.pool.AsyncResult`, whose `get()` method blocks until the
+result is ready and returns it (or raises the error).  These are plain
+threads with blocking I/O: the results can't be awaited by an event loop
+(eg: gevent, tornado or twisted), and at most `PYES_ASYNC_THREADS` requests
+are in progress at once.  The pool size is set by:
+
+ - `PYES_ASYNC_THREADS` (an integer, defaults to 20): The number of requests
+   which may be in progress at once; further requests wait for a thread.
+
 """
 
+import base64
 import copy
+import errno
+import httplib
+import multiprocessing.pool
+import json
+import socket
+import sys
+import threading
+import time
+import traceback
+from collections import OrderedDict
 from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.serializers.json import DjangoJSONEncoder
 import searchify
+from searchify.cache import get_result_cache
 import pyes
 import pyes.exceptions
 
 personal_prefix = getattr(settings, "PYES_PERSONAL_PREFIX", "")
 
+# Errors which indicate that a node couldn't be reached, or failed to respond.
+CONNECTION_ERRORS = (pyes.exceptions.NoServerAvailable, socket.error,
+                     httplib.HTTPException)
+
+# Socket error numbers which show that a connection couldn't be made, so the
+# request wasn't sent.
+CONNECT_ERRNOS = (errno.ECONNREFUSED, errno.EHOSTUNREACH, errno.ENETUNREACH,
+                  errno.EHOSTDOWN)
+
+def is_connect_error(e):
+    """Check whether an error shows that a connection to a node couldn't be
+    made (as opposed to a request failing or timing out once sent).
+
+    """
+    if isinstance(e, pyes.exceptions.NoServerAvailable):
+        return True
+    if isinstance(e, socket.timeout):
+        return False
+    if isinstance(e, socket.gaierror):
+        return True
+    return isinstance(e, socket.error) and e.errno in CONNECT_ERRNOS
+
+class Node(object):
+    """A node of the elasticsearch cluster.
+
+    Each thread using the node gets its own persistent connections to it: one
+    for bulk requests, and one for other requests.
+
+    """
+    def __init__(self, address, timeout, bulk_timeout):
+        self.address = address
+        self.timeout = timeout
+        self.bulk_timeout = bulk_timeout
+        # The time at which the node was marked as dead, or None if it's live.
+        self.dead_since = None
+        # The number of requests in a row which have failed.
+        self.failures = 0
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._conns = []
+
+    def get_connection(self, bulk=False, connect_timeout=None):
+        """Get this thread's connection to the node.
+
+        If a new connection is needed and connect_timeout is given, the node
+        is first checked to accept connections within connect_timeout seconds
+        (raising NoServerAvailable if it doesn't), so that an unreachable node
+        doesn't hold up the request for the full request timeout.
+
+        """
+        attr = bulk and 'bulk_conn' or 'conn'
+        conn = getattr(self._local, attr, None)
+        if conn is None:
+            if connect_timeout is not None and not self.probe(connect_timeout):
+                raise pyes.exceptions.NoServerAvailable(
+                    "Could not connect to %s" % self.address)
+            conn = pyes.ES(self.address,
+                           timeout=bulk and self.bulk_timeout or self.timeout)
+            setattr(self._local, attr, conn)
+            self._lock.acquire()
+            try:
+                self._conns.append(conn)
+            finally:
+                self._lock.release()
+        return conn
+
+    def _host_port(self):
+        address = self.address.split('://', 1)[-1].split('/', 1)[0]
+        (host, sep, port) = address.rpartition(':')
+        if not sep:
+            return (address, 9200)
+        return (host, int(port))
+
+    def probe(self, timeout):
+        """Check whether a connection can be made to the node.
+
+        """
+        try:
+            sock = socket.create_connection(self._host_port(), timeout)
+        except (socket.error, ValueError):
+            return False
+        sock.close()
+        return True
+
+    def check(self, timeout):
+        """Check whether the node is responding, within timeout seconds.
+
+        Nodes using the HTTP transport must answer a request for their status;
+        for the thrift transport (ports 9500 to 9599, as pyes decides), only a
+        connection can be checked.
+
+        """
+        try:
+            (host, port) = self._host_port()
+        except ValueError:
+            return False
+        if 9500 <= port < 9600:
+            return self.probe(timeout)
+        conn = httplib.HTTPConnection(host, port, timeout=timeout)
+        try:
+            conn.request('GET', '/')
+            return conn.getresponse().status < 500
+        except (socket.error, httplib.HTTPException):
+            return False
+        finally:
+            conn.close()
+
+    def close(self):
+        """Close all the connections to the node.
+
+        Threads using the node will open new connections when they next need
+        them.
+
+        """
+        self._lock.acquire()
+        try:
+            conns = self._conns
+            self._conns = []
+            self._local = threading.local()
+        finally:
+            self._lock.release()
+        for conn in conns:
+            try:
+                conn.connection.close()
+            except Exception:
+                pass
+
+class ConnectionPool(object):
+    """A pool of connections to the nodes of an elasticsearch cluster.
+
+    Requests are made with call(), which spreads them across the live nodes
+    in turn, and fails over to the next node if one can't be connected to
+    within connect_timeout seconds.  Such nodes are marked as dead, as are
+    nodes on which max_failures requests in a row have failed in other ways;
+    dead nodes are checked by a background thread every retry_interval
+    seconds until they respond (within connect_timeout) again.
+
+    """
+    def __init__(self, addresses, timeout=30, bulk_timeout=None,
+                 connect_timeout=5, retry_interval=30, max_failures=3):
+        if isinstance(addresses, basestring):
+            addresses = [addresses]
+        if bulk_timeout is None:
+            bulk_timeout = timeout
+        self.nodes = [Node(address, timeout, bulk_timeout)
+                      for address in addresses]
+        if not self.nodes:
+            raise ValueError("No elasticsearch addresses supplied")
+        self.connect_timeout = connect_timeout
+        self.retry_interval = retry_interval
+        self.max_failures = max_failures
+        self._lock = threading.Lock()
+        self._next = 0
+        self._reviver = None
+        self._closed = threading.Event()
+
+    def _candidates(self):
+        """Get the nodes to try for a request, in order.
+
+        The live nodes are taken in turn, starting at a different node for
+        each request; dead nodes are only tried (longest dead first) as a
+        last resort.
+
+        """
+        self._lock.acquire()
+        try:
+            live = [node for node in self.nodes if node.dead_since is None]
+            if live:
+                start = self._next % len(live)
+                self._next += 1
+                live = live[start:] + live[:start]
+            dead = sorted([node for node in self.nodes
+                           if node.dead_since is not None],
+                          key=lambda node: node.dead_since)
+        finally:
+            self._lock.release()
+        return live + dead
+
+    def call(self, func, bulk=False, retry_timeouts=False):
+        """Make a request, by calling func with a connection (a pyes.ES
+        object) to a node.
+
+        If a connection to the node can't be made, it is marked as dead and
+        the request is retried on the next node; if every node fails, the
+        error from the last node tried is raised.  Other errors (eg: timeouts,
+        or errors returned by elasticsearch itself) are raised immediately,
+        since the request may have been carried out.  If retry_timeouts is
+        True (for requests which are safe to repeat, such as searches), a
+        request which times out is also retried on the next node.
+
+        If bulk is True, the connection used has the bulk request timeout.
+
+        """
+        for node in self._candidates():
+            try:
+                result = func(node.get_connection(bulk, self.connect_timeout))
+            except CONNECTION_ERRORS, e:
+                if is_connect_error(e):
+                    self.mark_dead(node)
+                    error = sys.exc_info()
+                    continue
+                node.failures += 1
+                if node.failures >= self.max_failures:
+                    self.mark_dead(node)
+                if retry_timeouts and isinstance(e, socket.timeout):
+                    error = sys.exc_info()
+                    continue
+                raise
+            node.failures = 0
+            if node.dead_since is not None:
+                self.mark_live(node)
+            return result
+        raise error[0], error[1], error[2]
+
+    def mark_dead(self, node):
+        """Mark a node as dead, so that it's only used if no others are live.
+
+        """
+        node.close()
+        self._lock.acquire()
+        try:
+            if node.dead_since is None:
+                node.dead_since = time.time()
+            if self._reviver is None and not self._closed.isSet():
+                self._reviver = threading.Thread(target=self._revive)
+                self._reviver.setDaemon(True)
+                self._reviver.start()
+        finally:
+            self._lock.release()
+
+    def mark_live(self, node):
+        """Mark a node as live again.
+
+        """
+        self._lock.acquire()
+        try:
+            node.dead_since = None
+            node.failures = 0
+        finally:
+            self._lock.release()
+
+    def _revive(self):
+        while True:
+            self._closed.wait(self.retry_interval)
+            if self._closed.isSet():
+                return
+            for node in self.nodes:
+                if node.dead_since is not None and \
+                        node.check(self.connect_timeout):
+                    self.mark_live(node)
+            self._lock.acquire()
+            try:
+                if not [node for node in self.nodes
+                        if node.dead_since is not None]:
+                    self._reviver = None
+                    return
+            finally:
+                self._lock.release()
+
+    def close(self):
+        """Close all the connections in the pool.
+
+        """
+        self._closed.set()
+        for node in self.nodes:
+            node.close()
+
+class BulkError(Exception):
+    """Raised when some of the actions in a bulk request failed.
+
+    The errors attribute is a list of the error items returned by
+    elasticsearch.
+
+    """
+    def __init__(self, errors):
+        self.errors = errors
+        super(BulkError, self).__init__(
+            "%d bulk action(s) failed; first error: %s" %
+            (len(errors), errors[0]))
+
+_async_pool = None
+_async_pool_lock = threading.Lock()
+
+def run_async(func, *args, **kwargs):
+    """Call a function on the shared pool of threads.
+
+    Returns an AsyncResult for the call, whose get() method blocks the calling
+    thread until the call has finished.
+
+    """
+    global _async_pool
+    if _async_pool is None:
+        _async_pool_lock.acquire()
+        try:
+            if _async_pool is None:
+                _async_pool = multiprocessing.pool.ThreadPool(
+                    getattr(settings, 'PYES_ASYNC_THREADS', 20))
+        finally:
+            _async_pool_lock.release()
+    return _async_pool.apply_async(func, args, kwargs)
+
+class SearchError(Exception):
+    """Raised when one of the searches in a multi-search request failed.
+
+    position is the position of the search in the list of searches, and
+    error is the error returned by elasticsearch.
+
+    """
+    def __init__(self, position, error):
+        self.position = position
+        self.error = error
+        super(SearchError, self).__init__(
+            "Search %d failed: %s" % (position, error))
+
+class BulkBuffer(object):
+    """A buffer of actions to be sent to elasticsearch in bulk requests.
+
+    The buffer is sent when it holds max_docs actions, or when the actions
+    held exceed max_bytes.  If flush_interval is set, a background thread also
+    sends the buffer every flush_interval seconds.
+
+    If the bulk request fails (eg: because no node can be reached, or the
+    cluster is too busy to accept it), the actions are put back in the buffer,
+    to be sent by the next flush.  Only actions which elasticsearch rejects
+    individually are dropped, and reported by a BulkError.
+
+    The buffer is only locked while actions are added or taken from it; the
+    request is made (and the on_sent callbacks are called) without holding
+    that lock, so adding actions doesn't wait for the network.  Sends are
+    serialised, so that actions are sent in the order they were added.
+
+    An action may be given an on_sent callback, which is called once the
+    action has been accepted by elasticsearch.  The callback is passed a list
+    of the keys of the accepted actions given that callback, so that it is
+    called once per bulk request.
+
+    """
+    def __init__(self, client, max_docs, max_bytes, flush_interval=None):
+        self.client = client
+        self.max_docs = max_docs
+        self.max_bytes = max_bytes
+        self.flush_interval = flush_interval
+        self._lock = threading.Lock()
+        # Held while sending, so that only one request is made at a time.
+        self._send_lock = threading.Lock()
+        # (lines, on_sent, key) for each buffered action.
+        self._actions = []
+        self._bytes = 0
+        self._stopped = threading.Event()
+        self._thread = None
+        if flush_interval:
+            self._thread = threading.Thread(target=self._run)
+            self._thread.setDaemon(True)
+            self._thread.start()
+
+    @property
+    def background(self):
+        """True if a background thread is sending the buffer.
+
+        """
+        return self._thread is not None
+
+    def add(self, action, source=None, on_sent=None, key=None):
+        """Add an action to the buffer.
+
+        action is the action metadata (eg: {'index': {'_index': ...}}), and
+        source is the document for actions which need one.  If on_sent is
+        given, it is called with key (among others) once the action has been
+        accepted.
+
+        """
+        lines = [json.dumps(action, cls=DjangoJSONEncoder)]
+        if source is not None:
+            lines.append(json.dumps(source, cls=DjangoJSONEncoder))
+        self._lock.acquire()
+        try:
+            self._actions.append((lines, on_sent, key))
+            self._bytes += sum(len(line) + 1 for line in lines)
+            full = len(self._actions) >= self.max_docs or \
+                self._bytes >= self.max_bytes
+        finally:
+            self._lock.release()
+        # If another thread is already sending, leave the actions for the
+        # next send rather than waiting for it.
+        if full and self._send_lock.acquire(False):
+            try:
+                self._send()
+            finally:
+                self._send_lock.release()
+
+    def flush(self):
+        """Send any buffered actions.
+
+        """
+        self._send_lock.acquire()
+        try:
+            self._send()
+        finally:
+            self._send_lock.release()
+
+    def close(self):
+        """Stop the background thread (if any), and send any buffered actions.
+
+        """
+        if self._thread is not None:
+            self._stopped.set()
+            self._thread.join()
+            self._thread = None
+        self.flush()
+
+    def _send(self):
+        """Send the buffer.  Must be called with the send lock held.
+
+        """
+        self._lock.acquire()
+        try:
+            (actions, size) = (self._actions, self._bytes)
+            self._actions = []
+            self._bytes = 0
+        finally:
+            self._lock.release()
+        if not actions:
+            return
+        body = ''.join(line + '\n' for (lines, _, _) in actions
+                       for line in lines)
+        try:
+            response = self.client.call(
+                lambda conn: conn._send_request('POST', '/_bulk', body),
+                bulk=True)
+        except:
+            # Put the actions back, ahead of any added since, so that the next
+            # flush tries again.
+            self._lock.acquire()
+            try:
+                self._actions[:0] = actions
+                self._bytes += size
+            finally:
+                self._lock.release()
+            raise
+        # The items of the response are in the same order as the actions.
+        errors = []
+        sent = OrderedDict()
+        for ((_, on_sent, key), item) in zip(actions,
+                                            response.get('items', [])):
+            if [result for result in item.values() if 'error' in result]:
+                errors.append(item)
+            elif on_sent is not None:
+                sent.setdefault(on_sent, []).append(key)
+        for (on_sent, keys) in sent.iteritems():
+            on_sent(keys)
+        if errors:
+            raise BulkError(errors)
+
+    def _run(self):
+        while not self._stopped.isSet():
+            self._stopped.wait(self.flush_interval)
+            try:
+                self.flush()
+            except Exception:
+                # Keep the thread running; if the request couldn't be made,
+                # the next flush sends the actions again.
+                print >>sys.stderr, "Error sending bulk updates to elasticsearch:"
+                traceback.print_exc()
+
 class Client(object):
     """Client to talk to the pyes backend.
 
@@ -38,7 +584,46 @@ class Client(object):
 
     """
     def __init__(self):
-        self.conn = pyes.ES(settings.PYES_ADDRESS, timeout=30)
+        address = getattr(settings, 'PYES_ADDRESS', None)
+        read_addresses = getattr(settings, 'PYES_READ_ADDRESSES', address)
+        write_addresses = getattr(settings, 'PYES_WRITE_ADDRESSES', address)
+        if read_addresses is None or write_addresses is None:
+            raise ImproperlyConfigured('No elasticsearch address configured: '
+                                       'specify settings.PYES_ADDRESS')
+        self.write = self._make_pool(write_addresses)
+        if read_addresses == write_addresses:
+            self.read = self.write
+        else:
+            self.read = self._make_pool(read_addresses)
+        self.bulk = BulkBuffer(self,
+            getattr(settings, 'PYES_BULK_SIZE', 400),
+            getattr(settings, 'PYES_BULK_BYTES', 5 * 1024 * 1024),
+            getattr(settings, 'PYES_BULK_FLUSH_INTERVAL', None))
+
+    def _make_pool(self, addresses):
+        timeout = getattr(settings, 'PYES_TIMEOUT', 30)
+        return ConnectionPool(addresses,
+            timeout=timeout,
+            bulk_timeout=getattr(settings, 'PYES_BULK_TIMEOUT', timeout),
+            connect_timeout=getattr(settings, 'PYES_CONNECT_TIMEOUT', 5),
+            retry_interval=getattr(settings, 'PYES_RETRY_INTERVAL', 30),
+            max_failures=getattr(settings, 'PYES_MAX_FAILURES', 3))
+
+    def call(self, func, bulk=False, read=False, retry_timeouts=None):
+        """Make a request with a connection from a pool (see
+        ConnectionPool.call()).
+
+        Searches should pass read=True, to use the pool of read nodes; all
+        other requests use the pool of write nodes.  Requests which time out
+        are retried on another node if retry_timeouts is True, which defaults
+        to read.
+
+        """
+        if retry_timeouts is None:
+            retry_timeouts = read
+        if read:
+            return self.read.call(func, bulk, retry_timeouts)
+        return self.write.call(func, bulk, retry_timeouts)
 
     def get_indexer(self, indexname):
         """Get an indexer for a given index name.
@@ -52,6 +637,51 @@ class Client(object):
         """
         return PyesSearchQS(self, indexname)
 
+    def msearch(self, searches):
+        """Perform several searches with a single request.
+
+        searches is a list of (searcher, kwargs) pairs, where kwargs are the
+        keyword arguments to pass to the searcher's execute() method.  Returns
+        a list of SearchResultSets, in the same order.  Responses which are
+        in the result cache (see searchify.cache) aren't searched for again.
+
+        Raises SearchError if any of the searches failed.
+
+        """
+        results = [None] * len(searches)
+        lines = []
+        pending = []
+        for (position, (searcher, kwargs)) in enumerate(searches):
+            (search, body, doc_types, key) = searcher._prepare(**kwargs)
+            if key is not None:
+                response = get_result_cache().get(key)
+                if response is not None:
+                    results[position] = SearchResultSet(
+                        response, search, searcher._after)
+                    continue
+            header = dict(searcher.query_params, index=searcher._indexname)
+            if doc_types:
+                header['type'] = ','.join(doc_types)
+            lines.append(json.dumps(header))
+            lines.append(json.dumps(body, cls=DjangoJSONEncoder))
+            pending.append((position, searcher, search, key))
+        if not pending:
+            return results
+
+        body = '\n'.join(lines) + '\n'
+        response = self.call(
+            lambda conn: conn._send_request('GET', '/_msearch', body),
+            read=True)
+        for ((position, searcher, search, key), item) in \
+                zip(pending, response['responses']):
+            if 'error' in item:
+                raise SearchError(position, item['error'])
+            if key is not None:
+                get_result_cache().set(key, item)
+            results[position] = SearchResultSet(item, search,
+                                                searcher._after)
+        return results
+
     def all_indexes(self):
         """Return a dict with information on all known indexes.
 
@@ -66,7 +696,7 @@ class Client(object):
            is an alias for.
 
         """
-        indices = self.conn.get_indices(include_aliases=True)
+        indices = self.call(lambda conn: conn.get_indices(include_aliases=True))
         res = {}
         for index, info in indices.iteritems():
             if not index.startswith(personal_prefix):
@@ -93,7 +723,8 @@ class Client(object):
         """
         try:
             result = []
-            for indexname in self.conn.get_alias(personal_prefix + alias):
+            for indexname in self.call(
+                    lambda conn: conn.get_alias(personal_prefix + alias)):
                 if indexname.startswith(personal_prefix):
                     indexname = indexname[len(personal_prefix):]
                 result.append(indexname)
@@ -101,20 +732,72 @@ class Client(object):
         except pyes.exceptions.IndexMissingException:
             return []
 
+    def get_config_hashes(self, indexnames):
+        """Get the configuration hashes stored in the mappings of the named
+        indexes (or aliases), with a single request.
+
+        Returns a dict mapping each doc_type found to its stored hash (or None,
+        if it has no hash stored).  Indexes which don't exist are ignored.
+
+        """
+        if not indexnames:
+            return {}
+        path = '/%s/_mapping' % ','.join(personal_prefix + indexname
+                                         for indexname in indexnames)
+        try:
+            response = self.call(lambda conn: conn._send_request(
+                'GET', path, params=dict(ignore_indices='missing',
+                                         ignore_unavailable='true')))
+        except pyes.exceptions.IndexMissingException:
+            return {}
+        hashes = {}
+        for index_mappings in response.itervalues():
+            # Newer elasticsearch versions nest the types inside "mappings".
+            index_mappings = index_mappings.get('mappings', index_mappings)
+            for (doc_type, mapping) in index_mappings.iteritems():
+                hashes[doc_type] = mapping.get('_meta', {}).get('searchify_hash')
+        return hashes
+
     def delete_index(self, indexname):
         """Delete the named index (or alias).
 
         If the index is not found, does not raise an error.
 
         """
-        self.conn.delete_index_if_exists(personal_prefix + indexname)
-        self.conn.set_alias(personal_prefix + indexname, [])
+        self.call(lambda conn:
+                  conn.delete_index_if_exists(personal_prefix + indexname))
+        self.call(lambda conn: conn.set_alias(personal_prefix + indexname, []))
 
     def set_alias(self, alias, indexname):
         """Set an alias to point to an index.
 
         """
-        self.conn.set_alias(personal_prefix + alias, personal_prefix + indexname)
+        self.call(lambda conn: conn.set_alias(personal_prefix + alias,
+                                              personal_prefix + indexname))
+
+    def get_alias_async(self, alias):
+        """Get the indexes pointed to by an alias, without blocking.
+
+        Returns an AsyncResult for the result of get_alias().
+
+        """
+        return run_async(self.get_alias, alias)
+
+    def set_alias_async(self, alias, indexname):
+        """Set an alias to point to an index, without blocking.
+
+        Returns an AsyncResult.
+
+        """
+        return run_async(self.set_alias, alias, indexname)
+
+    def delete_index_async(self, indexname):
+        """Delete the named index (or alias), without blocking.
+
+        Returns an AsyncResult.
+
+        """
+        return run_async(self.delete_index, indexname)
 
     def flush(self):
         """Flush all changes made by the client.
@@ -124,15 +807,18 @@ class Client(object):
         updates to become searchable.
 
         """
-        self.conn.flush()
+        self.bulk.flush()
+        self.call(lambda conn: conn.flush())
 
     def close(self):
         """Close the client.
 
         """
+        self.bulk.close()
         self.flush()
-        self.conn.connection.close()
-        self.conn = None
+        self.write.close()
+        if self.read is not self.write:
+            self.read.close()
 
 
 class IndexerClient(object):
@@ -156,16 +842,31 @@ class IndexerClient(object):
     def _set_target_name(self):
         self._target_name = personal_prefix + self.indexname + self.suffix
 
+    def get_searcher(self):
+        """Get a searcher for the index (searching the live index, whatever
+        suffix is set).
+
+        """
+        return self.client.get_searcher(self.indexname)
+
     def create_index(self, index_settings):
-        self.client.conn.create_index(self._target_name, index_settings)
+        self.client.call(lambda conn:
+                         conn.create_index(self._target_name, index_settings))
 
-    def set_mapping(self, doc_type, fields):
+    def set_mapping(self, doc_type, fields, config_hash=None):
         """Create the index, and add settings for a given doc_type, with
         specified field configuration.
 
+        If config_hash is supplied, it is stored in the mapping's metadata
+        (see Client.get_config_hashes()).
+
         """
+        mapping = dict(properties=fields)
+        if config_hash is not None:
+            mapping['_meta'] = dict(searchify_hash=config_hash)
         try:
-            self.client.conn.put_mapping(doc_type, dict(properties=fields), self._target_name)
+            self.client.call(lambda conn: conn.put_mapping(
+                doc_type, mapping, self._target_name))
         except pyes.exceptions.MapperParsingException, e:
             raise ValueError("Could not parse mapping supplied to index %r "
                              "for type %r: %s" % (self.indexname, doc_type, e))
@@ -175,7 +876,8 @@ class IndexerClient(object):
 
         """
         try:
-            mapping = self.client.conn.get_mapping(doc_type, self._target_name)
+            mapping = self.client.call(
+                lambda conn: conn.get_mapping(doc_type, self._target_name))
         except pyes.exceptions.ElasticSearchException:
             return None
         if settings.ES_VERSION < 0.16:
@@ -195,34 +897,83 @@ class IndexerClient(object):
         except KeyError:
             return None
 
-    def add(self, doc, doc_type, docid):
+    def add(self, doc, doc_type, docid, on_sent=None):
         """Add a document of the specified doc_type and docid.
 
         Replaces any existing document of the same doc_type and docid.
 
+        The document is buffered, and sent in a bulk request with others.  If
+        on_sent is given, it is called with a list of (doc_type, docid) keys,
+        including this document's, once the document has been accepted.
+
         """
-        self.client.conn.index(doc, self._target_name, doc_type=doc_type, id=docid, bulk=True)
+        self.client.bulk.add({'index': {'_index': self._target_name,
+                                        '_type': doc_type,
+                                        '_id': docid}}, doc,
+                             on_sent=on_sent, key=(doc_type, docid))
 
-    def delete(self, doc_type, docid):
+    def delete(self, doc_type, docid, on_sent=None):
         """Delete the document of given doc_type and docid.
 
         Doesn't report an error if the document wasn't found.
 
+        The deletion is buffered, and sent in a bulk request with others.  If
+        on_sent is given, it is called as for add().
+
         """
-        try:
-            self.client.conn.delete(self._target_name, doc_type=doc_type, id=docid)
-        except pyes.exceptions.NotFoundException:
-            pass
+        self.client.bulk.add({'delete': {'_index': self._target_name,
+                                         '_type': doc_type,
+                                         '_id': docid}},
+                             on_sent=on_sent, key=(doc_type, docid))
 
-    def flush(self):
+    def flush(self, force=True):
         """Flush all changes made by the client.
 
         This forces all bulk updates to be sent to elasticsearch, but doesn't
         force a "refresh", so it may take some time after this call for the
         updates to become searchable.
 
+        If force is False and a background thread is sending the bulk updates
+        periodically (see PYES_BULK_FLUSH_INTERVAL), the updates are left for
+        it to send.
+
+        """
+        if force or not self.client.bulk.background:
+            self.client.bulk.flush()
+
+    def add_many_async(self, docs):
+        """Add several documents, and send them, without blocking.
+
+        docs is a list of (doc_type, docid, doc) tuples.  Returns an
+        AsyncResult, which completes once the documents have been sent.
+
+        """
+        def add_many():
+            for (doc_type, docid, doc) in docs:
+                self.add(doc, doc_type, docid)
+            self.client.bulk.flush()
+        return run_async(add_many)
+
+    def delete_many_async(self, keys):
+        """Delete several documents, and send the deletions, without blocking.
+
+        keys is a list of (doc_type, docid) pairs.  Returns an AsyncResult,
+        which completes once the deletions have been sent.
+
         """
-        self.client.flush()
+        def delete_many():
+            for (doc_type, docid) in keys:
+                self.delete(doc_type, docid)
+            self.client.bulk.flush()
+        return run_async(delete_many)
+
+    def flush_async(self):
+        """Send all buffered updates, without blocking.
+
+        Returns an AsyncResult.
+
+        """
+        return run_async(self.client.bulk.flush)
 
 class SearchQS(object):
     """A simple wrapper around a query and the parameters which will be used
@@ -233,14 +984,19 @@ class SearchQS(object):
     # implemented here isn't yet.
     def __init__(self, client, indexname):
         self._client = client
+        self._index = indexname
         self._indexname = personal_prefix + indexname
         self._doc_types = set()
 
     def clone(self):
         """Clone method, used when chaining.
 
+        The clone can be changed without affecting the original.
+
         """
-        return copy.copy(self)
+        result = copy.copy(self)
+        result._doc_types = set(self._doc_types)
+        return result
 
     def for_type(self, type):
         """Return a new SearchQS which searches only for a specific type.
@@ -257,7 +1013,7 @@ class SearchQS(object):
             result._doc_types.add(type)
         else:
             for t in type:
-                result._doc_types.add(type)
+                result._doc_types.add(t)
         return result
 
     def execute(self, **kwargs):
@@ -266,6 +1022,32 @@ class SearchQS(object):
         """
         raise NotImplementedError("Subclasses should implement this")
 
+def keyset_filter(sort, values):
+    """Make a filter matching the documents which sort after a document with
+    the given sort values.
+
+    sort is a list of {field: 'asc' or 'desc'} dicts, as built by
+    PyesSearchQS.order_by().  A document sorts after the values if, for some
+    field, its value is beyond the value given, and its values for all the
+    fields before that are equal to those given.  This only uses term and
+    range filters, so works with all versions of elasticsearch.
+
+    """
+    clauses = []
+    equal = []
+    for (item, value) in zip(sort, values):
+        (field, direction) = item.items()[0]
+        beyond = {'range': {field: {direction == 'desc' and 'lt' or 'gt':
+                                    value}}}
+        if equal:
+            clauses.append({'and': equal + [beyond]})
+        else:
+            clauses.append(beyond)
+        equal = equal + [{'term': {field: value}}]
+    if len(clauses) == 1:
+        return clauses[0]
+    return {'or': clauses}
+
 class PyesSearchQS(SearchQS):
     """A client for building searches.
 
@@ -275,6 +1057,14 @@ class PyesSearchQS(SearchQS):
         self._query = None
         self._facets = []
         self.query_params = {}
+        self._sort = None
+        self._after = None
+
+    def clone(self):
+        result = super(PyesSearchQS, self).clone()
+        result._facets = list(self._facets)
+        result.query_params = dict(self.query_params)
+        return result
 
     def execution_type(self, type):
         """Set the query execution type.
@@ -294,7 +1084,66 @@ class PyesSearchQS(SearchQS):
                         'dfs_query_and_fetch',
                         'dfs_query_then_fetch',
                        )
-        self.query_params['search_type'] = type
+        result.query_params['search_type'] = type
+        return result
+
+    def order_by(self, *fields):
+        """Sort the results by the given fields.
+
+        Fields prefixed with '-' are sorted in descending order.  With no
+        fields, the results are sorted by score.  The tiebreak field (see
+        PYES_TIEBREAK_FIELD) is added to the end of the order, so that
+        results with equal values are always in the same order, as needed for
+        paging with cursors (see after()).
+
+        """
+        result = self.clone()
+        if not fields:
+            fields = ('-_score',)
+        tiebreak = getattr(settings, 'PYES_TIEBREAK_FIELD', '_uid')
+        sort = []
+        for field in fields:
+            if field.startswith('-'):
+                sort.append({field[1:]: 'desc'})
+            else:
+                sort.append({field: 'asc'})
+        if tiebreak not in [field.lstrip('-') for field in fields]:
+            sort.append({tiebreak: 'asc'})
+        result._sort = sort
+        return result
+
+    def after(self, cursor):
+        """Return the page of results following the last result of a previous
+        page, given the cursor of that page's result set (see
+        SearchResultSet.cursor).
+
+        The cursor holds the sort values of the last result, and the search is
+        restricted with a filter to the documents which sort after them (see
+        keyset_filter()), so each page costs the same, however deep it is,
+        unlike paging with a start rank.  The search must have the same order
+        as the one which returned the cursor; if no order has been set, the
+        results are ordered by the tiebreak field.  The order can't include
+        the score, and the fields in it must be single-valued, unanalyzed and
+        present in every document.
+
+        """
+        try:
+            values = json.loads(base64.urlsafe_b64decode(str(cursor)))
+        except (TypeError, ValueError):
+            raise ValueError("Invalid search cursor: %r" % (cursor,))
+        if not isinstance(values, list):
+            raise ValueError("Invalid search cursor: %r" % (cursor,))
+        result = self.clone()
+        if result._sort is None:
+            result = result.order_by(
+                getattr(settings, 'PYES_TIEBREAK_FIELD', '_uid'))
+        if [field for sort in result._sort for field in sort
+            if field == '_score']:
+            raise ValueError("Cursors can't be used with searches ordered "
+                             "by score")
+        if len(values) != len(result._sort):
+            raise ValueError("Invalid search cursor: %r" % (cursor,))
+        result._after = values
         return result
 
     def add_facet(self, facet):
@@ -352,13 +1201,121 @@ class PyesSearchQS(SearchQS):
         return result
 
     def execute(self, **kwargs):
-        search = self._query.search(**kwargs)
+        """Perform the search, and return a SearchResultSet.
+
+        Keyword arguments (eg: start and size) are passed to pyes when
+        building the search.  If no query has been set, all documents match.
+
+        If a result cache is configured (see searchify.cache), the response is
+        taken from the cache if possible.
+
+        """
+        (search, body, doc_types, key) = self._prepare(**kwargs)
+        if key is not None:
+            response = get_result_cache().get(key)
+            if response is not None:
+                return SearchResultSet(response, search, self._after)
+
+        response = self._client.call(lambda conn: conn.search(
+            body, (self._indexname,), doc_types, **self.query_params),
+            read=True)
+        if key is not None:
+            get_result_cache().set(key, response)
+        return SearchResultSet(response, search, self._after)
+
+    def scan(self, batch_size=500, scroll='5m'):
+        """Iterate over all the matching documents, yielding SearchResults.
+
+        Uses the scan search type and the scroll API, so memory use doesn't
+        grow with the number of matches, and later batches cost no more than
+        earlier ones.  Each batch holds up to batch_size documents from each
+        shard.  scroll is how long elasticsearch keeps the scroll open
+        between batches.  The results aren't scored or sorted.
+
+        The scroll is cleared when the iteration finishes (or the generator
+        is closed).
+
+        """
+        search = self._build_search()
+        path = '/' + self._indexname
+        if self._doc_types:
+            path += '/' + ','.join(sorted(self._doc_types))
+        path += '/_search'
+        params = dict(self.query_params, search_type='scan', scroll=scroll,
+                      size=batch_size)
+        response = self._client.call(lambda conn: conn._send_request(
+            'GET', path, search.serialize(), params=params), read=True)
+        scroll_id = response.get('_scroll_id')
+        try:
+            while scroll_id:
+                # Each request moves the scroll on, so isn't repeated.
+                response = self._client.call(lambda conn: conn._send_request(
+                    'GET', '/_search/scroll', scroll_id,
+                    params=dict(scroll=scroll)), read=True,
+                    retry_timeouts=False)
+                scroll_id = response.get('_scroll_id')
+                hits = response.get('hits', {}).get('hits', [])
+                if not hits:
+                    break
+                for hit in hits:
+                    yield SearchResult.from_hit(hit)
+        finally:
+            if scroll_id:
+                try:
+                    self._client.call(lambda conn: conn._send_request(
+                        'DELETE', '/_search/scroll', scroll_id), read=True)
+                except Exception:
+                    # The scroll expires anyway, so don't hide the original
+                    # error (or the end of the iteration) if it can't be
+                    # cleared.
+                    pass
+
+    def execute_async(self, **kwargs):
+        """Perform the search without blocking.
+
+        Returns an AsyncResult for the SearchResultSet.
+
+        """
+        return run_async(self.execute, **kwargs)
+
+    def _build_search(self, **kwargs):
+        """Build the pyes Search to perform.
+
+        """
+        query = self._query
+        if query is None:
+            query = pyes.MatchAllQuery()
+        search = query.search(**kwargs)
         search.facet.facets = self._facets
-        response = self._client.conn.search(search,
-                                            (self._indexname,),
-                                            tuple(sorted(self._doc_types)),
-                                            **self.query_params)
-        return SearchResultSet(response, search)
+        return search
+
+    def _prepare(self, **kwargs):
+        """Build the search to perform.
+
+        Returns the pyes Search, the body of the request, the doc types to
+        search, and the result cache key for the search (or None if results
+        aren't being cached).
+
+        """
+        search = self._build_search(**kwargs)
+        body = search.serialize()
+        if self._sort is not None:
+            body['sort'] = self._sort
+            if self._after is not None:
+                body['query'] = {'filtered': {
+                    'query': body.get('query', {'match_all': {}}),
+                    'filter': keyset_filter(self._sort, self._after),
+                }}
+                body.pop('from', None)
+        doc_types = tuple(sorted(self._doc_types))
+
+        key = None
+        cache = get_result_cache()
+        if cache is not None:
+            key = cache.make_key(self._index, dict(
+                search=body, index=self._indexname,
+                doc_types=doc_types, query_params=self.query_params))
+        return (search, body, doc_types, key)
 
 class SearchResult(object):
     """An individual search result.
@@ -370,10 +1327,34 @@ class SearchResult(object):
         self.score = score
         self.hit = hit
 
+    @classmethod
+    def from_hit(cls, hit):
+        """Make a SearchResult from a hit returned by elasticsearch.
+
+        """
+        pk = long(hit['_id'])
+        type = searchify.utils.lookup_model(hit.get('_type'))
+        if type is None:
+            raise Exception("Model %s not found" % hit.get('_type'))
+        return cls(type, pk, hit.get('_score', 0), hit)
+
 class SearchResultSet(object):
-    def __init__(self, response, search):
-        self.start_rank = search.start
-        self.requested_size = search.size
+    def __init__(self, response, search, after=None):
+        """Make a result set from a search response.
+
+        after is the sort values the results follow, if the search was for the
+        page after a cursor; the start rank of the page is then unknown, and
+        is None.
+
+        """
+        if after is None:
+            self.start_rank = search.start or 0
+        else:
+            self.start_rank = None
+        if search.size is None:
+            self.requested_size = 10
+        else:
+            self.requested_size = search.size
         self.response = response
         self.search = search
         try:
@@ -387,7 +1368,24 @@ class SearchResultSet(object):
             facets = {}
         self._facets = facets
         self.count = hits.get('total', 0)
-        self.more_matches = (self.count > self.start_rank + self.requested_size)
+        if self.start_rank is None:
+            self.more_matches = (len(self._hits) >= self.requested_size)
+        else:
+            self.more_matches = (self.count >
+                                 self.start_rank + self.requested_size)
+
+    @property
+    def cursor(self):
+        """An opaque cursor for fetching the page after this one (see
+        PyesSearchQS.after()).
+
+        None if there are no results, or the search had no sort order (see
+        PyesSearchQS.order_by()).
+
+        """
+        if not self._hits or 'sort' not in self._hits[-1]:
+            return None
+        return base64.urlsafe_b64encode(json.dumps(self._hits[-1]['sort']))
 
     def __len__(self):
         """Get the number of result items in this result set.
@@ -398,8 +1396,44 @@ class SearchResultSet(object):
     @property
     def results(self):
         for hit in self._hits:
-            pk = long(hit['_id'])
-            type = searchify.utils.lookup_model(hit.get('_type'))
-            if type is None:
-                raise Exception("Model %s not found" % hit.get('_type'))
-            yield SearchResult(type, pk, hit.get('_score', 0), hit)
+            yield SearchResult.from_hit(hit)
+
+    def instances(self, select_related=None, only=None, manager=None):
+        """Get the model instances for the results, in rank order.
+
+        The instances are loaded with one query per model.  select_related (a
+        list of relation names, or True to follow all non-null foreign keys)
+        and only (a list of field names to load) are applied to each query.
+        If manager is supplied, instances of its model are loaded through it.
+
+        Each instance has the score and hit of its result attached, as
+        search_score and search_hit.  Results whose instances no longer exist
+        in the database are omitted.
+
+        """
+        results = list(self.results)
+        by_model = {}
+        for result in results:
+            by_model.setdefault(result.type, []).append(result.pk)
+        loaded = {}
+        for (model, pks) in by_model.iteritems():
+            if manager is not None and manager.model is model:
+                qs = manager.all()
+            else:
+                qs = model._default_manager.all()
+            if select_related is True:
+                qs = qs.select_related()
+            elif select_related:
+                qs = qs.select_related(*select_related)
+            if only:
+                qs = qs.only(*only)
+            loaded[model] = qs.in_bulk(pks)
+        instances = []
+        for result in results:
+            instance = loaded[result.type].get(result.pk)
+            if instance is None:
+                continue
+            instance.search_score = result.score
+            instance.search_hit = result.hit
+            instances.append(instance)
+        return instances
@@ -11,8 +11,28 @@ Further settings:
 
  - `RESTPOSE_PERSONAL_PREFIX`: prefixes the collection names
 
+ - `RESTPOSE_BULK_SIZE`: the number of document updates to buffer before
+   sending them (defaults to 400)
+
+ - `RESTPOSE_FLUSH_WAIT`: if True, flushing waits until the server has
+   processed the updates sent, and raises a CheckpointError if any of them
+   failed (defaults to False)
+
+Restpose has no aliases, so they are emulated: the collection each alias
+points to is recorded in a collection named `searchify_aliases` (with the
+personal prefix), and searchers look up the collection for an alias there.
+Lookups are cached for `RESTPOSE_ALIAS_CACHE_TIMEOUT` seconds (defaults to 5),
+so searchers switch to a new collection shortly after the alias is changed.
+
+Restpose has no request for updating several documents at once, so updates
+are buffered, and sent together when the buffer is flushed.  Only the last
+update buffered for each document is sent.  If an update can't be sent, it
+and the updates after it are kept in the buffer, to be sent by the next flush.
+
 """
 
+import threading
+from collections import OrderedDict
 from django.conf import settings
 import searchify
 import restpose
@@ -21,6 +41,17 @@ import restkit
 
 personal_prefix = getattr(settings, "RESTPOSE_PERSONAL_PREFIX", "")
 
+class CheckpointError(Exception):
+    """Raised when the server reports errors in processing updates.
+
+    The errors attribute is a list of the errors reported.
+
+    """
+    def __init__(self, errors):
+        self.errors = errors
+        super(CheckpointError, self).__init__(
+            "%d update(s) failed; first error: %s" % (len(errors), errors[0]))
+
 class Client(object):
 
     def __init__(self):
@@ -28,16 +59,119 @@ class Client(object):
         self.write = restpose.Server(
             getattr(settings, "RESTPOSE_MASTER_URL", settings.RESTPOSE_URL)
             )
+        self.bulk_size = getattr(settings, "RESTPOSE_BULK_SIZE", 400)
+        self.flush_wait = getattr(settings, "RESTPOSE_FLUSH_WAIT", False)
+        self._lock = threading.RLock()
+        self._collections = {}
+        # Map from (collection name, doc_type, docid) to the buffered update,
+        # which is (document to add or None for a deletion, on_sent callback).
+        self._buffer = OrderedDict()
+        self.alias_cache_timeout = getattr(settings,
+                                           "RESTPOSE_ALIAS_CACHE_TIMEOUT", 5)
+        # Map from alias to (collection name or None, time looked up).
+        self._aliases = {}
+
+    def get_collection(self, name):
+        """Get the handle of a collection, for writing to.
+
+        Handles are cached, rather than being made for every update.
+
+        """
+        coll = self._collections.get(name)
+        if coll is None:
+            coll = self._collections[name] = self.write.collection(name)
+        return coll
+
+    def buffer_update(self, name, doc_type, docid, doc, on_sent=None):
+        """Buffer an update to a document in a collection.
+
+        doc is the document to add, or None to delete the document.  Any
+        update already buffered for the document is replaced.  If on_sent is
+        given, it is called with a list of (doc_type, docid) keys, including
+        this document's, once the update has been sent.
+
+        """
+        self._lock.acquire()
+        try:
+            self._buffer[(name, doc_type, docid)] = (doc, on_sent)
+            if len(self._buffer) >= self.bulk_size:
+                self._send()
+        finally:
+            self._lock.release()
+
+    def _send(self):
+        """Send the buffered updates.  Must be called with the lock held.
+
+        Returns the names of the collections updated.
+
+        """
+        names = []
+        # Map from on_sent callback to the keys of the updates sent.
+        sent = OrderedDict()
+        try:
+            while self._buffer:
+                ((name, doc_type, docid), (doc, on_sent)) = \
+                    self._buffer.iteritems().next()
+                coll = self.get_collection(name)
+                if doc is None:
+                    coll.delete_doc(doc_type=doc_type, doc_id=docid)
+                else:
+                    coll.add_doc(doc, doc_type=doc_type, doc_id=docid)
+                del self._buffer[(name, doc_type, docid)]
+                if name not in names:
+                    names.append(name)
+                if on_sent is not None:
+                    sent.setdefault(on_sent, []).append((doc_type, docid))
+        finally:
+            for (on_sent, keys) in sent.iteritems():
+                on_sent(keys)
+        return names
 
     def get_indexer(self, indexname):
         return IndexerClient(self, indexname)
 
+    def _alias_collection(self, server):
+        return server.collection(personal_prefix + 'searchify_aliases')
+
+    def _lookup_alias(self, alias, refresh=False):
+        """Get the name of the collection an alias points to, or None if the
+        alias isn't set.
+
+        The result is cached, unless refresh is True (in which case the alias
+        is read from the master).
+
+        """
+        if not refresh:
+            cached = self._aliases.get(alias)
+            if cached is not None and \
+                    time.time() - cached[1] < self.alias_cache_timeout:
+                return cached[0]
+        server = refresh and self.write or self.read
+        try:
+            doc = self._alias_collection(server).get_doc('alias', alias)
+            target = doc.data.get('target')
+        except restkit.ResourceNotFound:
+            target = None
+        if isinstance(target, (list, tuple)):
+            target = target and target[0] or None
+        self._aliases[alias] = (target, time.time())
+        return target
+
     def get_searcher(self, indexname):
-        return self.read
+        """Get the collection to search for an index name (following the
+        alias, if the name is an alias).
+
+        """
+        target = self._lookup_alias(indexname)
+        if target is None:
+            target = indexname
+        return self.read.collection(personal_prefix + target)
 
     def all_indexes(self):
         res = {}
         for index in self.read.collections:
+            if index == personal_prefix + 'searchify_aliases':
+                continue
             coll = self.read.collection(index)
             status = coll.status
             info = {
@@ -47,19 +181,69 @@ class Client(object):
         return res
 
     def get_alias(self, alias):
+        """Get a list of the collections pointed to by an alias.
+
+        If there is no alias, but there is a collection of that name, returns
+        a list holding the name.  Returns an empty list if neither exists.
+
+        """
+        target = self._lookup_alias(alias, refresh=True)
+        if target is not None:
+            return [target]
+        if personal_prefix + alias in self.write.collections:
+            return [alias]
         return []
 
+    def get_config_hashes(self, indexnames):
+        # Configuration hashes aren't stored by this client.
+        return None
+
     def delete_index(self, indexname):
-        self.write.collection(indexname).delete()
+        """Delete the named collection, and any alias of that name.
+
+        """
+        self._collections.pop(personal_prefix + indexname, None)
+        self.write.collection(personal_prefix + indexname).delete()
+        if self._lookup_alias(indexname, refresh=True) is not None:
+            aliases = self._alias_collection(self.write)
+            aliases.delete_doc(doc_type='alias', doc_id=indexname)
+            aliases.checkpoint().wait()
+            self._aliases.pop(indexname, None)
 
     def set_alias(self, alias, indexname):
-        raise NotImplementedError("oh no not now")
+        """Set an alias to point to a collection.
+
+        Waits until the server has stored the alias.
+
+        """
+        aliases = self._alias_collection(self.write)
+        aliases.add_doc({'target': indexname}, doc_type='alias', doc_id=alias)
+        aliases.checkpoint().wait()
+        self._aliases[alias] = (indexname, time.time())
 
     def flush(self):
-        pass
+        """Send all buffered updates.
+
+        If RESTPOSE_FLUSH_WAIT is set, waits for the server to process them.
+
+        """
+        self._lock.acquire()
+        try:
+            names = self._send()
+        finally:
+            self._lock.release()
+        if not self.flush_wait:
+            return
+        errors = []
+        for name in names:
+            checkpoint = self.get_collection(name).checkpoint()
+            checkpoint.wait()
+            errors.extend(checkpoint.errors or ())
+        if errors:
+            raise CheckpointError(errors)
 
     def close(self):
-        pass
+        self.flush()
 
 
 class IndexerClient(object):
@@ -67,8 +251,6 @@ class IndexerClient(object):
         self.client = client
         self.indexname = indexname
         self.suffix = ''
-        self._target_name = None
-        self._set_target_name()
 
     def set_suffix(self, suffix=''):
         """Set a suffix to be appended to the index name for all subsequent
@@ -78,28 +260,63 @@ class IndexerClient(object):
 
         """
         self.suffix = suffix
-        self._set_target_name()
 
-    def _set_target_name(self):
-        self._target_name = personal_prefix + self.indexname + self.suffix
+    @property
+    def _target_name(self):
+        """The name of the collection to write to.
+
+        Without a suffix, this follows the alias for the index name (if it's
+        set), as searchers do, so that updates go to the collection being
+        searched.
+
+        """
+        if self.suffix:
+            return personal_prefix + self.indexname + self.suffix
+        target = self.client._lookup_alias(self.indexname)
+        if target is None:
+            target = self.indexname
+        return personal_prefix + target
 
     def create_index(self, index_settings):
-        coll = self.client.write.collection(self._target_name)
+        coll = self.client.get_collection(self._target_name)
         coll.config = index_settings
 
+    def get_searcher(self):
+        """Get the collection to search for this index.
+
+        """
+        return self.client.get_searcher(self.indexname)
+
     def set_fields(self, fields):
-        coll = self.client.write.collection(self._target_name)
+        coll = self.client.get_collection(self._target_name)
         config = coll.config
         config['fields'] = fields
         coll.config = config
 
-    def add(self, doc, doc_type, docid):
-        coll = self.client.write.collection(self._target_name)
-        coll.add_doc(doc, doc_type=doc_type, doc_id=docid)
+    def set_mapping(self, doc_type, fields, config_hash=None):
+        """Set the fields of the collection.
 
-    def delete(self, doc_type, docid):
-        coll = self.client.write.collection(self._target_name)
-        coll.delete_doc(doc_type=doc_type, doc_id=docid)
+        Restpose configures fields per collection rather than per doc_type.
+        config_hash isn't stored, since this client doesn't store
+        configuration hashes (see Client.get_config_hashes()).
 
-    def flush(self):
-        pass
+        """
+        self.set_fields(fields)
+
+    def get_mapping(self, doc_type):
+        """Get the fields configured for the collection, or None.
+
+        """
+        return self.client.get_collection(self._target_name).config \
+            .get('fields')
+
+    def add(self, doc, doc_type, docid, on_sent=None):
+        self.client.buffer_update(self._target_name, doc_type, docid, doc,
+                                  on_sent)
+
+    def delete(self, doc_type, docid, on_sent=None):
+        self.client.buffer_update(self._target_name, doc_type, docid, None,
+                                  on_sent)
+
+    def flush(self, force=True):
+        self.client.flush()
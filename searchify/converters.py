@@ -0,0 +1,66 @@
+"""Converters, which turn the values of Django model fields into data for the
+search engine.
+
+The converters used for each type of field are held in `Indexer.converters`;
+see `Indexer.register_converter()`.  Each converter takes a single non-None
+value, and returns the data to index.  Fields without a converter (including
+booleans and foreign keys) are indexed with unicode(); some of the converters
+here change that, and must be registered to be used.
+
+"""
+
+import json
+
+from django.core.serializers.json import DjangoJSONEncoder
+
+def datetime_converter(d):
+    """Convert a datetime to its date, in ISO format.
+
+    """
+    return unicode(d.date())
+
+def date_converter(d):
+    """Convert a date to ISO format.
+
+    """
+    return unicode(d.isoformat())
+
+def decimal_converter(d):
+    """Convert a Decimal, without using an exponent.
+
+    """
+    return unicode(format(d, 'f'))
+
+def boolean_converter(b):
+    """Convert a boolean to 'true' or 'false'.
+
+    Booleans are indexed as 'True' or 'False' unless this is registered for
+    BooleanField and NullBooleanField.
+
+    """
+    if b:
+        return u'true'
+    return u'false'
+
+def related_pk_converter(pk):
+    """Convert the value of a foreign key (ie, the primary key of the related
+    instance).
+
+    Foreign keys are indexed as unicode() of the related instance unless this
+    is registered for ForeignKey.  With it, foreign keys are read from the key
+    value (eg: `author_id` for a field named `author`), so the related
+    instance doesn't need to be loaded.
+
+    """
+    return unicode(pk)
+# Read the key value of the field (its attname), not the related instance.
+related_pk_converter.reads_key = True
+
+def json_converter(value):
+    """Convert a structured value (eg: from a JSON field) to JSON.
+
+    No field in Django itself needs this, but it can be registered for JSON
+    field classes (see `Indexer.register_converter()`).
+
+    """
+    return json.dumps(value, cls=DjangoJSONEncoder, sort_keys=True)
@@ -0,0 +1,205 @@
+"""Fingerprints of indexed documents, used to skip sending unchanged documents.
+
+If `settings.SEARCHIFY_FINGERPRINT_STORE` is set, a fingerprint of the data
+extracted for each document is kept when it is sent to a live index, and a
+document whose fingerprint hasn't changed since it was last sent isn't sent
+again.  The fingerprint is only recorded once the search engine client has
+sent the document, so a document whose update is lost (eg: because the client
+couldn't reach the search engine) is sent again by the next update.  The
+setting may be:
+
+ - 'memory': fingerprints are kept in a per-process LRU cache, holding
+   `settings.SEARCHIFY_FINGERPRINT_CACHE_SIZE` entries (default 10000).
+   This is only correct if a single process updates the index: a process
+   doesn't see the documents sent by others, so it can skip sending a
+   document which another process has since changed in the index.  Use the
+   'database' store if several processes (eg: web server workers) save
+   indexed models.
+
+ - 'database': fingerprints are kept in a database table (see
+   searchify.models.IndexFingerprint), shared by all processes.
+
+ - the dotted path of a subclass of FingerprintStore.
+
+Fingerprints are only checked for updates to live indices, not while
+rebuilding an index.  The fingerprints for an index are cleared when a rebuild
+of it goes live; note that for the 'memory' store, this can only clear the
+fingerprints held by the process doing the rebuild.
+
+"""
+
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import IntegrityError, transaction
+from django.utils.importlib import import_module
+
+def fingerprint(fielddata):
+    """Compute the fingerprint of the data for a document.
+
+    """
+    data = json.dumps(fielddata, cls=DjangoJSONEncoder, sort_keys=True)
+    return hashlib.md5(data.encode('utf-8')).hexdigest()
+
+class FingerprintStore(object):
+    """Base class for fingerprint stores.
+
+    Documents are identified by (doc_type, docid) keys within an index.
+
+    """
+    def get_many(self, index, keys):
+        """Get the fingerprints stored for a list of keys.
+
+        Returns a dict mapping keys to fingerprints, omitting keys with no
+        fingerprint stored.
+
+        """
+        raise NotImplementedError("Subclasses should implement this")
+
+    def set_many(self, index, fingerprints):
+        """Store fingerprints, given a dict mapping keys to fingerprints.
+
+        """
+        raise NotImplementedError("Subclasses should implement this")
+
+    def delete_many(self, index, keys):
+        """Remove the fingerprints stored for a list of keys.
+
+        """
+        raise NotImplementedError("Subclasses should implement this")
+
+    def clear(self, index):
+        """Remove all the fingerprints stored for an index.
+
+        """
+        raise NotImplementedError("Subclasses should implement this")
+
+class MemoryFingerprintStore(FingerprintStore):
+    """A store holding the most recently used fingerprints in memory.
+
+    Only suitable when a single process sends updates to the index (see the
+    module documentation).
+
+    """
+    def __init__(self, size=10000):
+        self.size = size
+        self._lock = threading.Lock()
+        self._items = OrderedDict()
+
+    def get_many(self, index, keys):
+        result = {}
+        self._lock.acquire()
+        try:
+            for key in keys:
+                value = self._items.pop((index, key), None)
+                if value is not None:
+                    self._items[(index, key)] = value
+                    result[key] = value
+        finally:
+            self._lock.release()
+        return result
+
+    def set_many(self, index, fingerprints):
+        self._lock.acquire()
+        try:
+            for (key, value) in fingerprints.iteritems():
+                self._items.pop((index, key), None)
+                self._items[(index, key)] = value
+            while len(self._items) > self.size:
+                self._items.popitem(last=False)
+        finally:
+            self._lock.release()
+
+    def delete_many(self, index, keys):
+        self._lock.acquire()
+        try:
+            for key in keys:
+                self._items.pop((index, key), None)
+        finally:
+            self._lock.release()
+
+    def clear(self, index):
+        self._lock.acquire()
+        try:
+            for item_key in [k for k in self._items if k[0] == index]:
+                del self._items[item_key]
+        finally:
+            self._lock.release()
+
+class DatabaseFingerprintStore(FingerprintStore):
+    """A store holding fingerprints in a database table.
+
+    """
+    def _dbkey(self, key):
+        return u'%s %s' % key
+
+    def get_many(self, index, keys):
+        from models import IndexFingerprint
+        dbkeys = dict((self._dbkey(key), key) for key in keys)
+        rows = IndexFingerprint.objects.filter(index=index,
+                                               key__in=dbkeys.keys())
+        return dict((dbkeys[row.key], row.fingerprint) for row in rows)
+
+    def set_many(self, index, fingerprints):
+        from models import IndexFingerprint
+        stored = self.get_many(index, fingerprints.keys())
+        for (key, value) in fingerprints.iteritems():
+            if key in stored:
+                if stored[key] != value:
+                    IndexFingerprint.objects.filter(
+                        index=index, key=self._dbkey(key)) \
+                        .update(fingerprint=value)
+                continue
+            sid = transaction.savepoint()
+            try:
+                IndexFingerprint.objects.create(index=index,
+                                                key=self._dbkey(key),
+                                                fingerprint=value)
+                transaction.savepoint_commit(sid)
+            except IntegrityError:
+                # Someone else stored a fingerprint for the document at the
+                # same time.
+                transaction.savepoint_rollback(sid)
+                IndexFingerprint.objects.filter(
+                    index=index, key=self._dbkey(key)) \
+                    .update(fingerprint=value)
+
+    def delete_many(self, index, keys):
+        from models import IndexFingerprint
+        IndexFingerprint.objects.filter(
+            index=index, key__in=[self._dbkey(key) for key in keys]).delete()
+
+    def clear(self, index):
+        from models import IndexFingerprint
+        IndexFingerprint.objects.filter(index=index).delete()
+
+_store = None
+def get_fingerprint_store():
+    """Get the configured fingerprint store, or None if fingerprints aren't
+    being kept.
+
+    """
+    global _store
+    if _store is None:
+        name = getattr(settings, 'SEARCHIFY_FINGERPRINT_STORE', None)
+        if name is None:
+            return None
+        if name == 'memory':
+            _store = MemoryFingerprintStore(
+                getattr(settings, 'SEARCHIFY_FINGERPRINT_CACHE_SIZE', 10000))
+        elif name == 'database':
+            _store = DatabaseFingerprintStore()
+        else:
+            try:
+                (module, classname) = name.rsplit('.', 1)
+                _store = getattr(import_module(module), classname)()
+            except (ValueError, ImportError, AttributeError), e:
+                raise ImproperlyConfigured(
+                    "Could not load SEARCHIFY_FINGERPRINT_STORE %r: %s" %
+                    (name, e))
+    return _store
@@ -1,34 +1,106 @@
 """Hooks to ensure that the indexer is informed when an indexed instance
 changes.
 
+If an update queue is configured (see searchify.queues), the hooks put the
+updates on the queue rather than making them immediately.
+
+Otherwise, deletions are left buffered in the client by the pre_delete hook,
+and the cascades from the deleted instances are collected by the post_delete
+hook.  When a queryset (or an instance, with the instances related to it) is
+deleted, Django sends all the pre_delete signals, and then all the
+post_delete signals in the same order; so once the post_delete signal for the
+last instance is received, the cascades are followed (indexing each target
+once), and the deletions and the cascades are sent together.
+
 """
 
+import threading
+
 from django.db.models.signals import post_save, pre_delete, post_delete
 
+from batching import get_current_batch
+from cascade import CascadePlan
 from index import get_indexer
+from queues import get_queue_for, make_update
+from utils import get_typename_from_object
+
+# The deletion in progress in each thread: the last instance for which
+# pre_delete was received, and the (indexer, instance, cascade keys) for the
+# instances for which post_delete has been received since.
+_local = threading.local()
 
 def connect_signals():
-    post_save.connect(index_hook)
-    pre_delete.connect(delete_hook)
+    post_save.connect(index_hook, weak=False,
+                      dispatch_uid='searchify.hooks.index_hook')
+    pre_delete.connect(delete_hook, weak=False,
+                       dispatch_uid='searchify.hooks.delete_hook')
+    post_delete.connect(post_delete_hook, weak=False,
+                        dispatch_uid='searchify.hooks.post_delete_hook')
 
 def index_hook(sender, **kwargs):
     instance = kwargs['instance']
     indexer = get_indexer(instance)
     if indexer:
-        indexer.index_instance(instance)
+        queue = get_queue_for(kwargs.get('using'))
+        if queue is not None:
+            queue.enqueue(make_update('index', indexer, instance))
+        else:
+            indexer.index_instance(instance)
 
 def delete_hook(sender, **kwargs):
     instance = kwargs['instance']
     indexer = get_indexer(instance)
     if indexer:
-        indexer.delete(instance)
-        post_delete.connect(post_delete_hook(instance))
-
-def post_delete_hook(instance):
-    def hook(sender, **kwargs):
-        if kwargs['instance'] == instance:
-            indexer = get_indexer(instance)
-            if indexer:
-                indexer.cascade(instance)
-            post_delete.disconnect(hook)
-    return hook
+        queue = get_queue_for(kwargs.get('using'))
+        if queue is not None:
+            queue.enqueue(make_update('delete', indexer, instance))
+        elif get_current_batch() is not None:
+            indexer.delete(instance)
+        else:
+            indexer.delete(instance, flush=False)
+            _local.last = instance
+
+def post_delete_hook(sender, **kwargs):
+    instance = kwargs['instance']
+    indexer = get_indexer(instance)
+    if not indexer:
+        return
+    queue = get_queue_for(kwargs.get('using'))
+    if queue is not None:
+        # The instance won't exist by the time the queue is processed, so
+        # find the cascade targets now.
+        for (target_indexer, target) in indexer.get_cascade_targets(instance):
+            queue.enqueue(make_update('index', target_indexer, target,
+                                      cascade=False))
+    elif get_current_batch() is not None:
+        indexer.cascade(instance)
+    else:
+        # Resolve the cascade now, while the instance has its primary key.
+        deleted = getattr(_local, 'deleted', None)
+        if deleted is None:
+            deleted = _local.deleted = []
+        deleted.append((indexer, instance, CascadePlan([]).resolve(instance)))
+        if getattr(_local, 'last', None) is instance:
+            _local.last = None
+            _local.deleted = None
+            finish_deletion(deleted)
+
+def finish_deletion(deleted):
+    """Follow the cascades from a list of deleted instances, and send the
+    deletions and the updates from the cascades.
+
+    deleted is a list of (indexer, instance, cascade keys) tuples.
+
+    """
+    plan = CascadePlan([], exclude=[
+        (get_typename_from_object(instance), instance.pk)
+        for (_, instance, _) in deleted
+    ], resolved=[(instance, keys) for (_, instance, keys) in deleted])
+    plan.execute(flush=False)
+    indexers = []
+    for indexer in [indexer for (indexer, _, _) in deleted] + \
+            [indexer for (indexer, _) in plan.get_targets()]:
+        if indexer.index and indexer not in indexers:
+            indexers.append(indexer)
+    for indexer in indexers:
+        indexer.client.flush(force=False)
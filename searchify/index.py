@@ -4,31 +4,121 @@ Searchify works by having a suitable subclass of Searchable available for each m
 This can be set up by one of:
 
  - Place a nested class in the model class called `Indexer`. (A single instance
-   will be created and registered for the model.)
+   will be created for the model when it is first used.)
  - Call `register_indexer` directly with an instance.
 
 """
 
 import copy
+import hashlib
+import json
+import operator
+import Queue
 import sys
+import threading
 import time
+import traceback
 
 from django.db import models
 from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
 
 import search # for make_searcher
+from converters import datetime_converter, date_converter, decimal_converter
 from clients import Client
-from utils import get_indexer, get_searcher, get_typename_from_object
+from batching import get_current_batch
+from cache import bump_generation, index_changed
+from cascade import CascadePlan
+from checkpoint import Checkpoint
+from fingerprints import fingerprint, get_fingerprint_store
+from utils import get_indexer, get_searcher, get_typename_from_object, \
+                  lookup_model
 
-client = Client()
+_client = None
+_client_lock = threading.Lock()
+_check_stale_pending = False
+
+def get_client():
+    """Get the search engine client shared by the indexers.
+
+    The client is created when this is first called, rather than when
+    searchify is imported, so that processes which never use the search engine
+    don't pay for connecting to it.
+
+    """
+    global _client, _check_stale_pending
+    if _client is not None:
+        return _client
+    _client_lock.acquire()
+    try:
+        if _client is None:
+            _client = Client()
+            check_stale = _check_stale_pending
+            _check_stale_pending = False
+        else:
+            check_stale = False
+    finally:
+        _client_lock.release()
+    if check_stale:
+        _start_stale_check()
+    return _client
 
 class SearchifyOptions(object):
-    def __init__(self, indexer=None):
-        self.indexer = indexer
+    """Searchify's options for a model, stored as `model._searchify`.
+
+    The indexer may be given as a class, in which case it is only instantiated
+    (and compiled) when it is first used.
+
+    """
+    def __init__(self, indexer=None, indexer_class=None, model=None):
+        self._indexer = indexer
+        self._indexer_class = indexer_class
+        self._model = model
+        self._lock = threading.Lock()
+
+    def _get_indexer(self):
+        if self._indexer is None and self._indexer_class is not None:
+            self._lock.acquire()
+            try:
+                if self._indexer is None:
+                    indexer = self._indexer_class(self._model)
+                    indexer.compile()
+                    self._indexer = indexer
+            finally:
+                self._lock.release()
+        return self._indexer
+
+    def _set_indexer(self, indexer):
+        self._indexer = indexer
+        self._indexer_class = None
+
+    indexer = property(_get_indexer, _set_indexer)
 
 # Map search index -> list of models which have an indexer for that index.
 _index_models = {} 
 
+def _lazy_searcher(model, manager):
+    """Make a searcher for a manager, which creates the real searcher (with
+    the model's indexer) when first called.
+
+    """
+    searchers = []
+    def query(*args, **kwargs):
+        if not searchers:
+            searchers.append(get_indexer(model).make_searcher(manager))
+        return searchers[0](*args, **kwargs)
+    return query
+
+def _register_index(model, index, managers):
+    if index:
+        _index_models.setdefault(index, []).append(model)
+
+        # managers is a list of attribute names (eg: ['objects']) for managers we want to
+        # decorate
+        for manager in managers:
+            manager = getattr(model, manager)
+            manager.query = _lazy_searcher(model, manager)
+
 def register_indexer(model, indexer):
     """Register an indexer on a model.
 
@@ -42,14 +132,23 @@ def register_indexer(model, indexer):
         model._searchify = SearchifyOptions()
     model._searchify.indexer = indexer
     indexer.model = model
-    if indexer.index:
-        _index_models.setdefault(indexer.index, []).append(model)
+    indexer.compile()
+    _register_index(model, indexer.index, indexer.managers)
 
-        # indexer.managers is a list of attribute names (eg: ['objects']) for managers we want to
-        # decorate
-        for manager in indexer.managers:
-            manager = getattr(model, manager)
-            manager.query = indexer.make_searcher(manager)
+def register_indexer_class(model, indexer_class):
+    """Register an indexer class on a model.
+
+    The indexer is instantiated from the class when it is first used (eg: by
+    get_indexer()), so that models which are never indexed or searched in a
+    process don't cost anything to set up.
+    """
+
+    if not hasattr(settings, 'ENABLE_SEARCHIFY') or not settings.ENABLE_SEARCHIFY:
+        return
+
+    model._searchify = SearchifyOptions(indexer_class=indexer_class,
+                                        model=model)
+    _register_index(model, indexer_class.index, indexer_class.managers)
 
 _ensure_dbs_exist = True
 def autodiscover(verbose=None, ensure_dbs_exist=None):
@@ -82,29 +181,141 @@ def autodiscover(verbose=None, ensure_dbs_exist=None):
         if not hasattr(model, '_searchify') and hasattr(model, 'Indexer'):
             # auto-register
             if verbose:
-                verbose.write("Auto-creating indexer instance for class %s\n" %
+                verbose.write("Auto-registering indexer for class %s\n" %
                               model)
-            register_indexer(model, model.Indexer(model))
+            register_indexer_class(model, model.Indexer)
 
     if not ensure_dbs_exist:
         return
 
-    # Now loop through and ensure each model has a mapping.
-    #for index, modellist in _index_models.items():
-    #    for model in modellist:
-    #        indexer = get_indexer(model)
-    #        if indexer.get_current_mapping() is None:
-    #            print >>sys.stderr, ("Mapping not stored for %r - need to run "
-    #                        "reindex command" % indexer.get_typename(model))
-    #            del _index_models[index]
-    #            break
-
-def reindex(indices):
+    # Checking that each index has been built with the current configuration
+    # needs a request to the search engine and all the indexers, so is only
+    # done if SEARCHIFY_CHECK_STALE is set (searchify_reindex --only-stale
+    # does its own check), and then in the background once the search engine
+    # is first used, rather than now.
+    if not getattr(settings, 'SEARCHIFY_CHECK_STALE', False):
+        return
+    global _check_stale_pending
+    if _client is None:
+        _check_stale_pending = True
+    else:
+        _start_stale_check()
+
+def _start_stale_check():
+    """Warn about indices which need to be rebuilt, from a background thread.
+
+    """
+    thread = threading.Thread(target=_warn_stale_indices)
+    thread.setDaemon(True)
+    thread.start()
+
+def _warn_stale_indices():
+    """Warn about indices which need to be rebuilt (see get_stale_indices()).
+
+    """
+    try:
+        stale = get_stale_indices()
+    except Exception, e:
+        print >>sys.stderr, ("Unable to check search index configuration: %s" %
+                             e)
+        return
+    for index in stale or ():
+        print >>sys.stderr, ("Configuration changed for index %r - need to run "
+                             "reindex command" % index)
+
+def get_index_settings(indexname):
+    """Get the index-wide settings for a named index.
+
+    These are merged from the index_settings of all the indexers for the
+    index; a ValueError is raised if they conflict.
+
+    """
+    index_settings = {}
+    def merge_dicts(path, a, b):
+        for (k, v) in b.iteritems():
+            if k not in a:
+                a[k] = copy.deepcopy(v)
+                continue
+            if isinstance(v, dict):
+                merge_dicts('%s.%s' % (path, k), a[k], v)
+                continue
+            if a[k] == v:
+                continue
+            raise ValueError("Conflicting values in index_settings (at %s)" % path[1:])
+    for model in _index_models.get(indexname, []):
+        indexer = get_indexer(model)
+        merge_dicts('.', index_settings, indexer.index_settings)
+    return index_settings
+
+_stale_indices = None
+def get_stale_indices(refresh=False):
+    """Get the names of the indices whose configuration has changed since they
+    were built, and so need to be reindexed.
+
+    The configuration hashes stored for all the indices are fetched with a
+    single request, and compared with the hashes of the current configuration
+    (see Indexer.get_configuration_hash()).  The result is cached, unless
+    refresh is True.
+
+    Returns None if the search engine client doesn't support storing
+    configuration hashes.
+
+    """
+    global _stale_indices
+    if _stale_indices is not None and not refresh:
+        return _stale_indices
+    stored = get_client().get_config_hashes(_index_models.keys())
+    if stored is None:
+        return None
+    stale = []
+    for (indexname, modellist) in _index_models.items():
+        index_settings = get_index_settings(indexname)
+        for model in modellist:
+            indexer = get_indexer(model)
+            typename = indexer.get_typename(model)
+            if stored.get(typename) != indexer.get_configuration_hash(index_settings):
+                stale.append(indexname)
+                break
+    _stale_indices = sorted(stale)
+    return _stale_indices
+
+class ReindexError(Exception):
+    """Raised when one or more indices failed to be rebuilt by reindex().
+
+    The failures attribute is a dict mapping the name of each index which
+    failed to the exception which caused it to fail.
+
+    """
+    def __init__(self, failures):
+        self.failures = failures
+        super(ReindexError, self).__init__(
+            "Failed to reindex: %s" % ', '.join(sorted(failures.keys())))
+
+def reindex(indices, workers=None, concurrency=None, resume=False,
+            only_stale=False):
     """Reindex the named indices, or all indices if none are named.
 
     The index is rebuilt from scratch with a new suffix, and the alias is then
     changed to point to the new index, so existing searchers should not be
     disrupted.
+
+    If workers is greater than 1, the instances of each model are indexed by
+    a pool of that many processes (see reindex_index()).
+
+    Up to concurrency indices (default: settings.SEARCHIFY_REINDEX_CONCURRENCY,
+    or 1) are rebuilt at once, each in its own thread and with its own search
+    client.  Each index is made live as soon as it has been rebuilt.  A failure
+    to rebuild one index doesn't stop the others being rebuilt; once all have
+    been attempted, a ReindexError is raised if any failed.  If workers is
+    also greater than 1, the indices being rebuilt share one pool of worker
+    processes, which is started before the threads (forking from a process
+    with other threads running could leave locks held in the workers).
+
+    If resume is True, indices with a checkpoint left by a failed rebuild
+    continue from where that rebuild got to (see reindex_index()).
+
+    If only_stale is True, only those of the indices whose configuration has
+    changed since they were built are rebuilt (see get_stale_indices()).
     """
     
     if not hasattr(settings, 'ENABLE_SEARCHIFY') or not settings.ENABLE_SEARCHIFY:
@@ -113,77 +324,309 @@ def reindex(indices):
     suffix = '_' + hex(int(time.time()))[2:]
     if not indices:
         indices = _index_models.keys()
+    if only_stale:
+        stale = get_stale_indices(refresh=True)
+        if stale is None:
+            print "Unable to tell which indices are stale; rebuilding all"
+        else:
+            indices = [indexname for indexname in indices if indexname in stale]
+    if concurrency is None:
+        concurrency = getattr(settings, 'SEARCHIFY_REINDEX_CONCURRENCY', 1)
+
+    pending = Queue.Queue()
     for indexname in indices:
-        reindex_index(indexname, suffix)
+        pending.put(indexname)
+    failures = {}
+    pool = None
+    if workers and workers > 1:
+        pool = _make_reindex_pool(workers)
+
+    def run():
+        from django.db import connection
+        search_client = Client()
+        try:
+            while True:
+                try:
+                    indexname = pending.get_nowait()
+                except Queue.Empty:
+                    return
+                try:
+                    reindex_index(indexname, suffix, workers, search_client,
+                                  resume, pool)
+                except Exception, e:
+                    print >>sys.stderr, "Failed to reindex %s:" % indexname
+                    traceback.print_exc()
+                    failures[indexname] = e
+        finally:
+            search_client.close()
+            connection.close()
 
-def reindex_index(indexname, suffix):
+    try:
+        if concurrency <= 1:
+            run()
+        else:
+            threads = [threading.Thread(target=run)
+                       for _ in range(min(concurrency, len(indices)))]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    if failures:
+        raise ReindexError(failures)
+
+def reindex_index(indexname, suffix, workers=None, search_client=None,
+                  resume=False, pool=None):
     """Reindex a named index.
+
+    If workers is greater than 1, the primary key space of each model is split
+    into ranges, which are indexed into the suffixed index by a pool of that
+    many processes (pool, if supplied, or a pool started for this index).
+    The alias is only changed once every range has been indexed successfully.
+
+    If search_client is supplied, it is used for all the updates (instead of
+    the clients of the indexers), so that several indices can be rebuilt
+    concurrently without sharing a connection.
+
+    Progress is recorded in a checkpoint (see searchify.checkpoint) as the
+    rebuild runs.  If the rebuild fails, the partly built index and the
+    checkpoint are kept; a later call with resume=True then continues
+    building that index from the checkpoint, rather than starting again.  A
+    later call without resume removes the partly built index instead.
     """
     
     if not hasattr(settings, 'ENABLE_SEARCHIFY') or not settings.ENABLE_SEARCHIFY:
         return
     
+    if search_client is None:
+        search_client = get_client()
     models = _index_models.get(indexname, None)
     if models is None:
         raise KeyError("Index %r is not known" % indexname)
+    checkpoint = None
     try:
 
-        # Get the index-wide settings.
-        index_settings = {}
-        def merge_dicts(path, a, b):
-            for (k, v) in b.iteritems():
-                if k not in a:
-                    a[k] = v
-                    continue
-                if isinstance(v, dict):
-                    merge_dicts('%s.%s' % (path, k), a[k], v)
-                    continue
-                if a[k] == v:
-                    continue
-                raise ValueError("Conflicting values in index_settings (at %s)" % path[1:])
-        for model in models:
-            indexer = get_indexer(model)
-            merge_dicts('.', index_settings, indexer.index_settings)
+        index_settings = get_index_settings(indexname)
 
-        created = False
+        checkpoint = Checkpoint.load(indexname)
+        if checkpoint is not None and resume:
+            suffix = checkpoint.suffix
+            print "Resuming reindex of %s, using suffix %s" % (indexname, suffix)
+        else:
+            if checkpoint is not None:
+                print "Removing partly built index: %s" % (
+                    indexname + checkpoint.suffix)
+                search_client.delete_index(indexname + checkpoint.suffix)
+                checkpoint.delete()
+            checkpoint = Checkpoint(indexname, suffix)
+
+        index_client = search_client.get_indexer(indexname)
+        index_client.set_suffix(suffix)
+        if not checkpoint.created:
+            #print "Creating index with settings %r" % index_settings
+            index_client.create_index(index_settings)
+            checkpoint.set_created()
         for model in models:
-            print "Indexing %s to %s, using suffix %s" % (model, indexname, suffix)
             indexer = get_indexer(model)
+            typename = get_typename_from_object(model)
+            if checkpoint.get_ranges(typename) is None:
+                if workers and workers > 1:
+                    checkpoint.set_ranges(typename,
+                                          indexer.get_pk_ranges(workers * 4))
+                else:
+                    checkpoint.set_ranges(typename, [(None, None)])
+            old_client = indexer.client
             try:
-                indexer.client.set_suffix(suffix)
-                if not created:
-                    #print "Creating index with settings %r" % index_settings
-                    indexer.client.create_index(index_settings)
-                    created = True
-                indexer.apply_mapping()
-                indexer.index_all(with_cascade=False)
+                indexer.client = index_client
+                indexer.apply_mapping(index_settings)
+                if not workers or workers < 2:
+                    print "Indexing %s to %s, using suffix %s" % (model, indexname, suffix)
+                    for (after_pk, upto_pk) in checkpoint.get_ranges(typename):
+                        def progress(pk):
+                            checkpoint.advance(typename, upto_pk, pk)
+                        indexer.index_all(with_cascade=False, after_pk=after_pk,
+                                          upto_pk=upto_pk, progress=progress)
+                        checkpoint.complete(typename, upto_pk)
             finally:
-                indexer.client.set_suffix()
-            indexer.client.flush()
+                indexer.client = old_client
+            index_client.flush()
+
+        if workers and workers > 1:
+            _reindex_with_pool(indexname, suffix, models, workers, checkpoint,
+                               pool)
 
         # Get the old value of the alias.
         try:
-            old_index = client.get_alias(indexname)[0]
+            old_index = search_client.get_alias(indexname)[0]
         except IndexError:
             old_index = None
         if old_index == indexname:
             # Old index wasn't an alias; we have to delete it and then set the
             # new alias for it.
-            print "Warning: no alias in use, so must delete in-use index"
+            print "Warning: no alias in use for %s, so must delete in-use index" % indexname
             old_index = None
-            client.delete_index(indexname)
-        print "Setting alias to make new index live"
-        client.set_alias(indexname, indexname + suffix)
+            search_client.delete_index(indexname)
+        print "Setting alias to make new index %s live" % (indexname + suffix)
+        search_client.set_alias(indexname, indexname + suffix)
+        bump_generation(indexname)
+        store = get_fingerprint_store()
+        if store is not None:
+            store.clear(indexname)
+        if _stale_indices is not None and indexname in _stale_indices:
+            _stale_indices.remove(indexname)
     except:
+        if checkpoint is not None and checkpoint.created:
+            print >>sys.stderr, ("Reindex of %s failed; progress saved in %s, "
+                                 "so the reindex can be resumed" %
+                                 (indexname, checkpoint.get_path(indexname)))
+            raise
         try:
-            client.delete_index(indexname + suffix)
+            search_client.delete_index(indexname + suffix)
         except Exception:
             # Ignore any normal exceptions, so we report the original error.
             pass
         raise
+    checkpoint.delete()
     if old_index:
         print "Removing old index: %s" % old_index
-        client.delete_index(old_index)
+        search_client.delete_index(old_index)
+
+def _make_reindex_pool(workers):
+    """Start a pool of worker processes for reindexing.
+
+    This must be called while no other threads are running, since the worker
+    processes are forked from this one.
+
+    """
+    import multiprocessing
+    from django.db import connection
+
+    # Don't let the worker processes share our database connection.
+    connection.close()
+    return multiprocessing.Pool(workers, _init_reindex_worker)
+
+def _reindex_with_pool(indexname, suffix, models, workers, checkpoint,
+                       pool=None):
+    """Index all instances of the given models into the suffixed index, using
+    a pool of worker processes.
+
+    The ranges of primary keys to index for each model are taken from the
+    checkpoint, which is updated as each range is completed.  Each model's
+    primary key space is usually split into several ranges per worker, so that
+    uneven distributions of primary keys still keep all the workers busy.
+    Raises an exception if any range fails to be indexed.
+
+    If pool is None, a pool of that many processes is started (and stopped
+    once done); otherwise, the pool supplied is used (and left running).
+
+    """
+    tasks = []
+    for model in models:
+        typename = get_typename_from_object(model)
+        for (after_pk, upto_pk) in checkpoint.get_ranges(typename):
+            tasks.append((indexname, suffix, typename, after_pk, upto_pk))
+
+    if pool is not None:
+        for (_, _, typename, after_pk, upto_pk) in \
+                pool.imap_unordered(_reindex_pk_range, tasks):
+            print "Indexed %s to %s (pks after %s up to %s), using suffix %s" % (
+                typename, indexname, after_pk, upto_pk, suffix)
+            checkpoint.complete(typename, upto_pk)
+        return
+
+    pool = _make_reindex_pool(workers)
+    try:
+        _reindex_with_pool(indexname, suffix, models, workers, checkpoint,
+                           pool)
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+def _init_reindex_worker():
+    """Initialise a process in the reindexing pool.
+
+    The process gets its own database connection and search client, rather
+    than sharing those of the parent.
+
+    """
+    global _client, _check_stale_pending
+    from django.db import connection
+    connection.close()
+    _client = Client()
+    _check_stale_pending = False
+
+def _reindex_pk_range(task):
+    """Index a range of primary keys for a model into a suffixed index.
+
+    Runs in a reindexing pool worker process.
+
+    """
+    (indexname, suffix, typename, after_pk, upto_pk) = task
+    try:
+        indexer = get_indexer(lookup_model(typename))
+        indexer.client = get_client().get_indexer(indexname)
+        indexer.client.set_suffix(suffix)
+        indexer.index_all(with_cascade=False, after_pk=after_pk, upto_pk=upto_pk)
+    except:
+        # The traceback is lost when the exception is passed back to the parent
+        # process, so display it here.
+        traceback.print_exc()
+        raise
+    return task
+
+class FieldAccessor(object):
+    """An accessor, in an extraction plan, for an attribute of an instance
+    (typically a Django model field), with a converter for its values.
+
+    """
+    def __init__(self, attname, converter):
+        self.attname = attname
+        self.converter = converter
+
+    def __call__(self, instance):
+        val = getattr(instance, self.attname)
+        if val is None:
+            return []
+        return [self.converter(val)]
+
+    def column(self, instances):
+        """Get the data for a list of instances (as a list of lists).
+
+        """
+        converter = self.converter
+        return [[converter(val)] if val is not None else []
+                for val in map(operator.attrgetter(self.attname), instances)]
+
+class CallableAccessor(object):
+    """An accessor, in an extraction plan, for a callable field descriptor.
+
+    The callable should return a list of values; a single string is treated
+    as a list holding it, and None as an empty list.
+
+    """
+    def __init__(self, func):
+        self.func = func
+
+    def __call__(self, instance):
+        values = self.func(instance)
+        if values is None:
+            return []
+        if isinstance(values, basestring):
+            return [values]
+        return values
+
+    def column(self, instances):
+        """Get the data for a list of instances (as a list of lists).
+
+        """
+        return map(self, instances)
 
 class Indexer(object):
     """Main indexer superclass, controlling search indexing for a model.
@@ -204,13 +647,56 @@ class Indexer(object):
     index_settings = {} # A dictionary of engine specific index-level settings.
     fields = []
     cascades = [] # no cascades
-    managers = [] # don't create searcher by default (still pondering details, and searchers unported to class approach)
+    managers = [] # names of managers to add a query() method to (see searchify.search.make_searcher)
     defaults = {}
 
+    # Hints applied to the queryset used when indexing instances in bulk (eg:
+    # by index_all()).  select_related and prefetch_related are lists of
+    # relation names (or True, for select_related, to follow all non-null
+    # foreign keys); only is a list of field names to load.  Use these to avoid
+    # a query per instance from fields and callables which follow relations.
+    select_related = None
+    prefetch_related = None
+    only = None
+
+    # Number of instances to load in each query when indexing in bulk.
+    chunk_size = 1000
+
+    # If fingerprints are being kept (see searchify.fingerprints), whether to
+    # skip the cascade from instances whose documents haven't changed.  Only
+    # set this if the cascades depend solely on the data indexed.
+    skip_unchanged_cascades = False
+
+    # The extraction plan, built from fields by compile().
+    _plan = None
+
+    # Converters for values of Django model fields, keyed by field class.  See
+    # get_converter() and register_converter().  Other fields (including
+    # foreign keys, whose related instances are indexed) are converted with
+    # unicode().
+    converters = {
+        models.DateTimeField: datetime_converter,
+        models.DateField: date_converter,
+        models.DecimalField: decimal_converter,
+    }
+
     def __init__(self, model):
         self.model = model
-        if self.index:
-            self.client = client.get_indexer(self.index)
+        self._converter_cache = {}
+        self._client = None
+
+    def _get_client(self):
+        """The client used to update the index, created when first needed.
+
+        """
+        if self._client is None and self.index:
+            self._client = get_client().get_indexer(self.index)
+        return self._client
+
+    def _set_client(self, client):
+        self._client = client
+
+    client = property(_get_client, _set_client)
 
     def reindex_on_cascade(self, cascade_from, cascade_to):
         """
@@ -232,82 +718,337 @@ class Indexer(object):
     def get_searcher(self):
         return self.client.get_searcher()
 
-    def index_all(self, with_cascade=True):
+    def get_queryset(self):
+        """Get the queryset used when indexing instances of this model in bulk.
+
+        This applies the select_related, prefetch_related and only hints.
+
+        """
+        qs = self.model._default_manager.all()
+        if self.select_related is True:
+            qs = qs.select_related()
+        elif self.select_related:
+            qs = qs.select_related(*self.select_related)
+        if self.prefetch_related:
+            qs = qs.prefetch_related(*self.prefetch_related)
+        if self.only:
+            qs = qs.only(*self.only)
+        return qs
+
+    def get_pk_ranges(self, count):
+        """Split the primary keys of this model into (up to) count ranges.
+
+        Returns a list of (after_pk, upto_pk) tuples, suitable for passing to
+        index_all().  The first range has an after_pk of None and the last an
+        upto_pk of None, so instances created while indexing aren't missed.
+
+        Only integer primary keys can be split; for other primary keys, a
+        single range covering all instances is returned.
+
+        """
+        from django.db.models import Min, Max
+        bounds = self.model._default_manager.aggregate(lo=Min('pk'), hi=Max('pk'))
+        (lo, hi) = (bounds['lo'], bounds['hi'])
+        if not isinstance(lo, (int, long)) or not isinstance(hi, (int, long)):
+            return [(None, None)]
+        step = max(1, (hi - lo + count) // count)
+        edges = range(lo + step - 1, hi, step)
+        return zip([None] + edges, edges + [None])
+
+    def iter_chunks(self, after_pk=None, upto_pk=None):
+        """Iterate through all the instances of this model, in chunks.
+
+        Yields lists of at most chunk_size instances, in primary key order.
+        Each chunk is fetched with a separate query, starting after the last
+        primary key seen (rather than using an OFFSET, which gets slower the
+        further through the table we get), so only one chunk is held in
+        memory at a time.
+
+        If after_pk is supplied, only instances with a primary key greater
+        than after_pk are returned; if upto_pk is supplied, only instances with
+        a primary key no greater than upto_pk are returned.
+
+        """
+        qs = self.get_queryset().order_by('pk')
+        if upto_pk is not None:
+            qs = qs.filter(pk__lte=upto_pk)
+        last_pk = after_pk
+        while True:
+            if last_pk is None:
+                chunk = list(qs[:self.chunk_size])
+            else:
+                chunk = list(qs.filter(pk__gt=last_pk)[:self.chunk_size])
+            if not chunk:
+                return
+            last_pk = chunk[-1].pk
+            yield chunk
+            if len(chunk) < self.chunk_size:
+                return
+
+    def index_all(self, with_cascade=True, after_pk=None, upto_pk=None,
+                  progress=None):
         """Index or reindex all the instances of this model.
 
         If with_cascade is True, the cascade of instances depending on this
         instance will also be traversed, to update any search data built from
         these instances.
 
+        Instances are loaded in chunks (see iter_chunks()), so memory use
+        doesn't grow with the size of the table.  after_pk and upto_pk may be
+        used to index only a range of instances, as for iter_chunks().
+
+        If progress is supplied, it is called with the primary key of the last
+        instance in each chunk, once that chunk has been indexed and flushed.
+
         """
-        from django.db import connection
-        for inst in self.model.objects.all():
-            self.index_instance(inst, with_cascade)
-            del inst
-            connection.queries = []
+        from django.db import reset_queries
+        for chunk in self.iter_chunks(after_pk, upto_pk):
+            self.index_instances(chunk, with_cascade, flush=False)
+            if progress is not None:
+                self.client.flush()
+                progress(chunk[-1].pk)
+            del chunk
+            reset_queries()
         self.client.flush()
 
-    def index_instance(self, instance, with_cascade=True):
+    def index_instance(self, instance, with_cascade=True, flush=True):
         """Index or reindex an instance.
 
         If with_cascade is True, the cascade of instances depending on this
         instance will also be traversed, to update any search data built from
         these instances.
 
+        If flush is True, the update is sent to the search engine (unless the
+        client is sending updates in the background); otherwise it may be left
+        buffered in the client until it is next flushed.
+
+        If a batch is active (see searchify.batch()) and flush is True, the
+        update is recorded in the batch instead of being performed now.
+
         """
+        pending = get_current_batch()
+        if pending is not None and flush:
+            if self.index:
+                pending.add('index', self, instance)
+            if with_cascade:
+                pending.add_cascade(self, instance)
+            return
+        self.index_instances([instance], with_cascade, flush)
+
+    def index_instances(self, instances, with_cascade=True, flush=True):
+        """Index or reindex a list of instances.
+
+        This is equivalent to calling index_instance() on each instance, but
+        extracts the data for all the instances together (see
+        get_index_data_many()), and plans a single cascade for them all.
+
+        If fingerprints are being kept (see searchify.fingerprints), documents
+        which haven't changed aren't sent.  If skip_unchanged_cascades is also
+        set, the cascades from instances whose documents haven't changed
+        aren't followed either.
+
+        """
+        pending = get_current_batch()
+        if pending is not None and flush:
+            for instance in instances:
+                self.index_instance(instance, with_cascade)
+            return
+        cascade_from = instances
         if self.index:
-            if not self.should_be_in_index(instance):
-                self.client.delete(self.get_typename(instance),
-                                   self.get_docid(instance))
-            else:
-                dret = self.get_index_data(instance)
-                if dret is not None:
-                    (doc_type, docid, fielddata) = dret
-                    self.client.add(fielddata, doc_type=doc_type, docid=docid)
-        if with_cascade:
-            self.cascade(instance)
-        if self.index:
-            self.client.flush()
+            to_index = []
+            to_delete = []
+            for instance in instances:
+                if not self.should_be_in_index(instance):
+                    to_delete.append(instance)
+                else:
+                    to_index.append(instance)
+            self.delete_documents([(self.get_typename(instance),
+                                    self.get_docid(instance))
+                                   for instance in to_delete])
+            sent = self.add_documents([dret for dret in
+                                       self.get_index_data_many(to_index)
+                                       if dret is not None])
+            if self.skip_unchanged_cascades:
+                sent = set(sent)
+                cascade_from = to_delete + [
+                    instance for instance in to_index
+                    if (self.get_typename(instance),
+                        self.get_docid(instance)) in sent]
+        if with_cascade and cascade_from:
+            CascadePlan(cascade_from).execute(flush)
+        if self.index and flush:
+            self.client.flush(force=False)
+
+    def _get_fingerprint_store(self):
+        """Get the fingerprint store, if fingerprints should be checked for
+        updates made by this indexer's client.
+
+        Fingerprints are only kept for the live index, not for an index being
+        rebuilt with a suffix.
+
+        """
+        if self.client.suffix:
+            return None
+        return get_fingerprint_store()
+
+    def _results_changed(self, keys):
+        """Invalidate the search results cached for the index (see
+        searchify.cache).  Called by the client once updates to the live
+        index have been sent.
+
+        """
+        index_changed(self.index)
+
+    def _get_sent_callback(self):
+        """Get the callback to pass to the client for updates, if the results
+        cached for the index need to be invalidated once they're sent.
+
+        """
+        if self.client.suffix:
+            return None
+        return self._results_changed
+
+    def add_documents(self, docs):
+        """Send documents to the index.
+
+        docs is a list of (doc_type, docid, fielddata) tuples, as returned by
+        get_index_data().  Documents whose fingerprint is unchanged aren't
+        sent.  Returns a list of the (doc_type, docid) keys which were sent.
+
+        The documents may be buffered by the client; their fingerprints are
+        only recorded once the client has sent them.
 
-    def cascade(self, instance):
+        """
+        store = self._get_fingerprint_store()
+        if store is None:
+            on_sent = self._get_sent_callback()
+            for (doc_type, docid, fielddata) in docs:
+                self.client.add(fielddata, doc_type=doc_type, docid=docid,
+                                on_sent=on_sent)
+            return [(doc_type, docid) for (doc_type, docid, _) in docs]
+
+        prints = dict(((doc_type, docid), fingerprint(fielddata))
+                      for (doc_type, docid, fielddata) in docs)
+        stored = store.get_many(self.index, prints.keys())
+        changed = {}
+        def record(keys):
+            store.set_many(self.index, dict((key, changed[key])
+                                            for key in keys))
+            self._results_changed(keys)
+        for (doc_type, docid, fielddata) in docs:
+            key = (doc_type, docid)
+            if stored.get(key) != prints[key]:
+                changed[key] = prints[key]
+                self.client.add(fielddata, doc_type=doc_type, docid=docid,
+                                on_sent=record)
+        return changed.keys()
+
+    def delete_documents(self, keys):
+        """Delete documents from the index, given a list of (doc_type, docid)
+        keys.
+
+        """
+        if not keys:
+            return
+        store = self._get_fingerprint_store()
+        if store is None:
+            on_sent = self._get_sent_callback()
+            for (doc_type, docid) in keys:
+                self.client.delete(doc_type, docid, on_sent=on_sent)
+        else:
+            # Forget the fingerprints now, so that the documents are sent if
+            # they're added again before the deletions are sent, and again
+            # once the deletions are sent, in case a buffered addition
+            # recorded them in the meantime.
+            store.delete_many(self.index, keys)
+            def forget(keys):
+                store.delete_many(self.index, keys)
+                self._results_changed(keys)
+            for (doc_type, docid) in keys:
+                self.client.delete(doc_type, docid, on_sent=forget)
+
+    def cascade(self, instance, flush=True):
         """Cascade the index from this instance to others that depend on it.
 
         This causes index_instance() to be called on each instance that depends
-        on the instance supplied.
+        on the instance supplied.  If flush is True, the clients used are
+        flushed (once each) afterwards.
+
+        If a batch is active and flush is True, the cascade is recorded in the
+        batch instead of being performed now.
 
         """
-        for descriptor in self.cascades:
-            cascade_inst = None
-            # find the instance we're being told to cascade the reindex onto
-            try:
-                if callable(descriptor):
-                    cascade_inst = descriptor(instance)
-                elif isinstance(descriptor, str):
-                    cascade_inst = getattr(instance, descriptor)
-            except:
-                cascade_inst = None
-            # if we found one, check if it's searchable, check if it
-            # wants to accept the cascade, and if so, reindex it
-            if cascade_inst:
-                # If it's not an iterable already, make it into one
-                if not hasattr(cascade_inst, '__iter__'):
-                    cascade_insts = [cascade_inst]
-                else:
-                    cascade_insts = cascade_inst
-                for cascade_inst in cascade_insts:
-                    indexer = get_indexer(cascade_inst)
-                    if indexer and indexer.reindex_on_cascade(instance, cascade_inst):
-                        indexer.index_instance(cascade_inst, with_cascade=False)
+        pending = get_current_batch()
+        if pending is not None and flush:
+            pending.add_cascade(self, instance)
+            return
+        CascadePlan([instance]).execute(flush)
+
+    def get_cascade_targets(self, instance):
+        """Get the instances which the index should cascade to from instance.
+
+        Returns a list of (indexer, instance) pairs for the instances which
+        have an indexer and accept the cascade (see reindex_on_cascade()).
+        See searchify.cascade for how the cascade is resolved.
 
-    def delete(self, instance):
+        """
+        return CascadePlan([instance]).get_targets()
+
+    def delete(self, instance, flush=True):
         """Delete an instance from the (relevant) search index.
 
+        If flush is False, the deletion may be left buffered in the client.
+        If a batch is active and flush is True, the deletion is recorded in
+        the batch instead of being performed now.
+
         """
 
+        pending = get_current_batch()
+        if pending is not None and flush:
+            pending.add('delete', self, instance)
+            return
         if self.index:
-            self.client.delete(self.get_typename(instance),
-                               self.get_docid(instance))
-            self.client.flush()
+            self.delete_documents([(self.get_typename(instance),
+                                    self.get_docid(instance))])
+            if flush:
+                self.client.flush(force=False)
+
+    def delete_many(self, instances_or_pks, flush=True):
+        """Delete several instances from the search index.
+
+        instances_or_pks may be a queryset, or a sequence of instances or
+        primary keys.  For primary keys (and querysets, of which only the
+        primary keys are loaded), get_typename() and get_docid() are passed an
+        instance with only its primary key set.
+
+        The deletions are sent in bulk.  If flush is False, they may be left
+        buffered in the client.  If a batch is active and flush is True, they
+        are recorded in the batch instead of being performed now.
+
+        """
+        if isinstance(instances_or_pks, models.query.QuerySet):
+            instances = (self.model(pk=pk) for pk in
+                         instances_or_pks.values_list('pk', flat=True).iterator())
+        else:
+            instances = (item if isinstance(item, models.Model)
+                         else self.model(pk=item) for item in instances_or_pks)
+
+        pending = get_current_batch()
+        if pending is not None and flush:
+            for instance in instances:
+                pending.add('delete', self, instance)
+            return
+        if not self.index:
+            return
+        keys = []
+        for instance in instances:
+            keys.append((self.get_typename(instance), self.get_docid(instance)))
+            if len(keys) >= self.chunk_size:
+                self.delete_documents(keys)
+                keys = []
+        self.delete_documents(keys)
+        if flush:
+            self.client.flush(force=False)
 
     def get_typename(self, instance):
         """Generate a type name for use in the search database.
@@ -331,22 +1072,136 @@ class Indexer(object):
         Given a Django model instance, return a unique identifier and a
         dictionary of search fields mapping to lists of data, or None.
 
+        The data is extracted by running the extraction plan (see compile()).
+
         """
         if not self.fields:
             return None
 
         outfields = {}
 
-        for field in self.fields:
-            (django_field_list, index_fieldname, index_config) = self.get_details(field)
-            # print "indexing %s (%s)" % (instance, index_fieldname,)
-            interim_data = map(lambda x: self.get_field_input(instance, x), django_field_list)
-            # print '>>>' + str(interim_data)
-            outfields[index_fieldname] = reduce(lambda x,y: list(x) + list(y), interim_data)
+        for (index_fieldname, accessors) in self.get_plan():
+            values = []
+            for accessor in accessors:
+                values.extend(accessor(instance))
+            outfields[index_fieldname] = values
 
         return (self.get_typename(instance), self.get_docid(instance),
                 outfields)
 
+    def get_index_data_many(self, instances):
+        """Get the data to be indexed for a list of instances.
+
+        Returns a list of the results of get_index_data() for each instance.
+        The plan is run a column at a time: each accessor reads and converts
+        its values for all the instances together.
+
+        """
+        if type(self).get_index_data.im_func is not Indexer.get_index_data.im_func:
+            # get_index_data() has been overridden, so must be used.
+            return [self.get_index_data(instance) for instance in instances]
+        if not self.fields:
+            return [None] * len(instances)
+
+        docs = [{} for instance in instances]
+        for (index_fieldname, accessors) in self.get_plan():
+            columns = [accessor.column(instances) for accessor in accessors]
+            for (i, doc) in enumerate(docs):
+                values = []
+                for column in columns:
+                    values.extend(column[i])
+                doc[index_fieldname] = values
+
+        return [(self.get_typename(instance), self.get_docid(instance), doc)
+                for (instance, doc) in zip(instances, docs)]
+
+    def get_plan(self):
+        """Get the extraction plan, compiling it if necessary.
+
+        """
+        if self._plan is None:
+            self.compile()
+        return self._plan
+
+    def compile(self):
+        """Compile self.fields into an extraction plan.
+
+        The plan is a list of (search field name, accessors) pairs, where each
+        accessor is a callable taking an instance and returning a list of data
+        for the search field.  All the per-field work (generating search field
+        names, looking up Django fields and choosing converters) is done here,
+        so extracting the data for an instance doesn't need to do any of it.
+
+        This is called when the indexer is registered; it should be called
+        again if self.fields is changed after that.
+
+        """
+        plan = []
+        for field in self.fields:
+            (django_field_list, index_fieldname, _) = self.get_details(field)
+            plan.append((index_fieldname,
+                         [self.get_accessor(django_field)
+                          for django_field in django_field_list]))
+        self._plan = plan
+        return plan
+
+    def get_accessor(self, django_field):
+        """Get an accessor for a single Django field descriptor (string or
+        callable), for use in the extraction plan.
+
+        """
+        if type(self).get_field_input.im_func is not Indexer.get_field_input.im_func:
+            # get_field_input() has been overridden, so must be used.
+            return CallableAccessor(
+                lambda instance: self.get_field_input(instance, django_field))
+        if isinstance(django_field, str):
+            try:
+                model_field = self.model._meta.get_field(django_field)
+            except models.FieldDoesNotExist:
+                return FieldAccessor(django_field, unicode)
+            converter = self.get_converter(model_field)
+            if getattr(converter, 'reads_key', False):
+                # Read the key value of a foreign key, rather than loading the
+                # related instance.
+                return FieldAccessor(model_field.attname, converter)
+            return FieldAccessor(model_field.name, converter)
+        elif callable(django_field):
+            return CallableAccessor(django_field)
+        else:
+            return CallableAccessor(lambda instance: [])
+
+    def get_converter(self, model_field):
+        """Get the converter to use for values of a Django model field.
+
+        The converter is looked up in self.converters using the class of the
+        field, or the nearest of its base classes which has a converter; if
+        none do, unicode() is used.  The result is cached for each field.
+
+        """
+        try:
+            return self._converter_cache[model_field]
+        except KeyError:
+            pass
+        converter = unicode
+        for field_class in type(model_field).__mro__:
+            if field_class in self.converters:
+                converter = self.converters[field_class]
+                break
+        self._converter_cache[model_field] = converter
+        return converter
+
+    @classmethod
+    def register_converter(cls, field_class, converter):
+        """Register a converter for a class of Django model field (and its
+        subclasses), for this indexer class and its subclasses.
+
+        This must be called before indexers are registered (eg: at import time)
+        to affect their extraction plans.
+
+        """
+        converters = dict(cls.converters)
+        converters[field_class] = converter
+        cls.converters = converters
 
     def get_details(self, field):
         """
@@ -393,7 +1248,10 @@ class Indexer(object):
         Given a single Django field descriptor (string or callable), generate a list of data to input to the search field.
 
         Converters allow Django ORM types to be modified automatically (eg: returning DateTimeField in a useful format).
-        Currently, converters are embedded here, which isn't helpful.
+        See get_converter().
+
+        This isn't used when extracting data for indexing unless it has been overridden; the
+        extraction plan built by compile() is used instead.
         """
 
         # must return an iterable; django_field is str (name) or callable
@@ -401,21 +1259,15 @@ class Indexer(object):
             #print 'trying as str'
             #print '.name = %s' % instance.name
             #print 'getattr(,"name") = %s' % getattr(instance, 'name')
-            val = getattr(instance, django_field)
-
-            def datetime_converter(d):
-                return unicode(d.date())
-
-            # FIXME: converters should be on the class, not embedded in this method
-            converters = { models.DateTimeField: datetime_converter }
-            field_type = instance._meta.get_field(django_field).__class__
+            model_field = instance._meta.get_field(django_field)
+            converter = self.get_converter(model_field)
+            if getattr(converter, 'reads_key', False):
+                val = getattr(instance, model_field.attname)
+            else:
+                val = getattr(instance, model_field.name)
             if val == None:
                 return []
-            if field_type in converters:
-                val = converters[field_type](val)
-            else:
-                val = unicode(val)
-            return [val]
+            return [converter(val)]
         elif callable(django_field):
             return django_field(instance)
         else:
@@ -440,16 +1292,46 @@ class Indexer(object):
         typename = self.get_typename(self.model)
         return self.client.get_mapping(typename)
 
-    def apply_mapping(self):
+    def get_configuration_hash(self, index_settings=None):
+        """Get a hash of the configuration for this indexer (including the
+        converters registered), and the settings of its index.
+
+        This is stored with the mapping by apply_mapping(), so that changes to
+        the configuration can be detected (see get_stale_indices()).
+        index_settings defaults to the settings of the indexer's index (see
+        get_index_settings()).
+
+        """
+        if index_settings is None:
+            index_settings = get_index_settings(self.index)
+        converters = dict(
+            ('%s.%s' % (field_class.__module__, field_class.__name__),
+             '%s.%s' % (getattr(converter, '__module__', None),
+                        getattr(converter, '__name__', repr(converter))))
+            for (field_class, converter) in self.converters.iteritems())
+        data = json.dumps(dict(settings=index_settings,
+                               fields=self.get_configuration(),
+                               converters=converters),
+                          cls=DjangoJSONEncoder, sort_keys=True)
+        return hashlib.md5(data).hexdigest()
+
+    def apply_mapping(self, index_settings=None):
         """Apply the configuration for this indexer to the search engine.
 
+        A hash of the configuration (see get_configuration_hash()) is stored
+        with it.
+
         """
         mapping = self.get_configuration()
         typename = self.get_typename(self.model)
-        self.client.set_mapping(typename, mapping)
+        self.client.set_mapping(typename, mapping,
+            config_hash=self.get_configuration_hash(index_settings))
 
     def make_searcher(self, manager):
         """Make a searcher for the given manager.
 
+        This is used as the manager's query() method; see
+        searchify.search.make_searcher().
+
         """
         return search.make_searcher(manager, self.model)
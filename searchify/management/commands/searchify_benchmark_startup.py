@@ -0,0 +1,62 @@
+from django.core.management.base import BaseCommand
+from optparse import make_option
+import os
+import subprocess
+import sys
+
+# Run in a fresh interpreter for each measurement.  Prints the time taken to
+# load all the apps (which registers the indexers), and then the time taken to
+# create the search engine client.
+_SCRIPT = """
+import sys, time
+start = time.time()
+from django.conf import settings
+settings.ENABLE_SEARCHIFY = %(enable)r
+from django.db.models.loading import get_models
+get_models()
+loaded = time.time()
+if settings.ENABLE_SEARCHIFY:
+    from searchify.index import get_client
+    get_client()
+sys.stdout.write('%%f %%f\\n' %% (loaded - start, time.time() - loaded))
+"""
+
+class Command(BaseCommand):
+    help = """Measure the time searchify adds to starting a process.
+
+Starts a fresh Python process for each run, and times loading all the apps
+with searchify enabled and disabled, and the time taken to create the search
+engine client on first use.
+
+    """.strip()
+
+    option_list = BaseCommand.option_list + (
+        make_option('--repeat', action='store', type='int',
+                    dest='repeat', default=5,
+                    help='Number of runs of each measurement.'),
+    )
+
+    def run(self, enable):
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.pathsep.join(sys.path)
+        proc = subprocess.Popen([sys.executable, '-c',
+                                 _SCRIPT % {'enable': enable}],
+                                stdout=subprocess.PIPE, env=env)
+        output = proc.communicate()[0]
+        if proc.returncode:
+            raise RuntimeError("Benchmark process failed")
+        return [float(t) for t in output.split()]
+
+    def handle(self, *args, **kwargs):
+        repeat = max(kwargs.get('repeat', 5), 1)
+        enabled = [self.run(True) for _ in range(repeat)]
+        disabled = [self.run(False) for _ in range(repeat)]
+
+        def report(label, times):
+            times = sorted(times)
+            self.stdout.write("%-30s min %.3fs  median %.3fs\n" % (
+                label, times[0], times[len(times) // 2]))
+
+        report("Load apps (searchify enabled)", [t[0] for t in enabled])
+        report("Load apps (searchify disabled)", [t[0] for t in disabled])
+        report("Create search client", [t[1] for t in enabled])
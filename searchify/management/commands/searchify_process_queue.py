@@ -0,0 +1,39 @@
+from django.core.management.base import BaseCommand, CommandError
+import searchify
+from searchify.queues import get_queue
+from optparse import make_option
+import time
+
+class Command(BaseCommand):
+    help = """Make the index updates waiting in the update queue.
+
+The updates are made in batches, loading the instances for each batch with one
+query per model and sending their updates to the search engine in bulk.
+
+With --interval, keeps checking the queue at that interval (in seconds) rather
+than exiting once the queue is empty.
+
+    """.strip()
+
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', action='store', type='int',
+                    dest='batch_size', default=500,
+                    help='Number of updates to make in each batch.'),
+        make_option('--interval', action='store', type='float',
+                    dest='interval', default=None,
+                    help='Keep processing the queue at this interval.'),
+    )
+
+    def handle(self, *args, **kwargs):
+        queue = get_queue()
+        if queue is None:
+            raise CommandError("No update queue configured: set "
+                               "settings.SEARCHIFY_QUEUE")
+        interval = kwargs.get('interval')
+        while True:
+            count = queue.drain(kwargs.get('batch_size', 500))
+            if int(kwargs.get('verbosity', 1)) > 1 or interval is None:
+                self.stdout.write("Made %d queued updates\n" % count)
+            if interval is None:
+                return
+            time.sleep(interval)
@@ -19,8 +19,39 @@ deleted.
 This means that searches will switch over the the new index only after a
 successsful reindex.
 
+With --workers, the instances of each model are split into ranges of primary
+key, which are indexed in parallel by that many worker processes.
+
+With --concurrency, up to that many indices are rebuilt at once.  Each index is
+made live as soon as it has been rebuilt, and a failure to rebuild one index
+doesn't stop the others from being rebuilt.  With --workers as well, the
+indices being rebuilt share one pool of worker processes.
+
+Progress is checkpointed to a file (in settings.SEARCHIFY_CHECKPOINT_DIR, or
+the system temporary directory) as the reindex runs.  If a reindex fails, the
+partly built index is kept, and running again with --resume continues building
+it from the checkpoint.  Running again without --resume discards it.
+
+With --only-stale, only the indices whose configuration (fields and settings)
+has changed since they were last built are reindexed.
+
     """.strip()
 
+    option_list = BaseCommand.option_list + (
+        make_option('--workers', action='store', type='int', dest='workers',
+                    default=None,
+                    help='Number of worker processes to index with.'),
+        make_option('--concurrency', action='store', type='int',
+                    dest='concurrency', default=None,
+                    help='Number of indices to rebuild at once.'),
+        make_option('--resume', action='store_true', dest='resume',
+                    default=False,
+                    help='Resume failed reindexes from their checkpoints.'),
+        make_option('--only-stale', action='store_true', dest='only_stale',
+                    default=False,
+                    help='Only reindex indices whose configuration changed.'),
+    )
+
     requires_model_validation = False
 
     def __init__(self):
@@ -36,4 +67,10 @@ successsful reindex.
 
         searchify.autodiscover(ensure_dbs_exist=False)
         self.validate()
-        searchify.reindex(args)
+        try:
+            searchify.reindex(args, workers=kwargs.get('workers'),
+                              concurrency=kwargs.get('concurrency'),
+                              resume=kwargs.get('resume', False),
+                              only_stale=kwargs.get('only_stale', False))
+        except searchify.ReindexError, e:
+            raise CommandError(str(e))
@@ -1,15 +1,52 @@
-"""Initialisation for the searchify app.
+"""Models and initialisation for the searchify app.
 
-Despite the name, this file doesn't actually contain any models. It's just used
-to contain initialisation for the searchify app, which is called at Django
-setup time.
+The models here are QueuedUpdate, used by the database update queue (see
+searchify.queues), and IndexFingerprint, used by the database fingerprint
+store (see searchify.fingerprints).  This file also contains initialisation for
+the searchify app, which is called at Django setup time.
 
 """
 
 from django.conf import settings
+from django.db import models
 from hooks import connect_signals
 from index import autodiscover
 
+class QueuedUpdate(models.Model):
+    """An index update waiting in the database update queue.
+
+    There is at most one entry for each model instance; queueing a further
+    update for an instance replaces the action of the existing entry.
+
+    """
+    # 'index' or 'delete'
+    action = models.CharField(max_length=10)
+    # The model, as returned by get_typename_from_object().
+    model = models.CharField(max_length=200)
+    object_pk = models.CharField(max_length=255)
+    # The document type and id in the index (needed to delete the document
+    # once the instance no longer exists).
+    doc_type = models.CharField(max_length=200)
+    docid = models.CharField(max_length=255)
+    # Whether to follow the cascade from the instance when indexing it.
+    cascade = models.BooleanField(default=True)
+    queued_at = models.DateTimeField(db_index=True)
+
+    class Meta:
+        unique_together = (('model', 'object_pk'),)
+
+class IndexFingerprint(models.Model):
+    """The fingerprint of the data last sent for a document in an index.
+
+    """
+    index = models.CharField(max_length=200)
+    # The doc_type and docid of the document, separated by a space.
+    key = models.CharField(max_length=255)
+    fingerprint = models.CharField(max_length=32)
+
+    class Meta:
+        unique_together = (('index', 'key'),)
+
 if hasattr(settings, 'ENABLE_SEARCHIFY') and settings.ENABLE_SEARCHIFY:
     connect_signals()
     autodiscover()
@@ -0,0 +1,283 @@
+"""Queues of index updates, decoupling indexing from saving instances.
+
+By default, index updates are made synchronously by the signal hooks (see
+searchify.hooks) when an instance is saved or deleted.  If
+`settings.SEARCHIFY_QUEUE` is set, the hooks instead put updates on a queue,
+and they are made later, in bulk.  The setting may be:
+
+ - 'thread': updates are queued in memory, and made by a background thread in
+   the same process.  Any updates still queued are made when the process
+   exits.  The thread can't see changes which haven't been committed, so
+   updates for instances saved or deleted within a managed transaction (eg:
+   with TransactionMiddleware, or in a commit_on_success block) aren't
+   queued, but made synchronously, as if no queue were configured.
+
+ - 'database': updates are queued in a database table (see
+   searchify.models.QueuedUpdate), and made by running the
+   `searchify_process_queue` management command.  The entries are committed
+   along with the changes, so this can be used within any transaction.
+
+ - the dotted path of a subclass of UpdateQueue.
+
+Only one update is queued for each instance: a later update replaces an
+earlier one which hasn't yet been made.
+
+"""
+
+import atexit
+import datetime
+import operator
+import sys
+import threading
+import traceback
+from collections import namedtuple
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import IntegrityError, transaction
+from django.db.models import Q
+from django.utils.importlib import import_module
+
+from batching import batch
+from utils import get_indexer, get_typename_from_object, lookup_model
+
+# An update: action is 'index' or 'delete'; model is the typename of the model
+# (as returned by get_typename_from_object()); cascade is whether to follow the
+# cascade from the instance when indexing it.
+Update = namedtuple('Update', 'action model object_pk doc_type docid cascade')
+
+def make_update(action, indexer, instance, cascade=True):
+    """Make an Update for an action on an instance.
+
+    """
+    return Update(action, get_typename_from_object(instance),
+                  unicode(instance.pk), indexer.get_typename(instance),
+                  indexer.get_docid(instance), cascade)
+
+def merge_updates(old, new):
+    """Merge a new update for an instance with one already queued.
+
+    The new action replaces the old one, but if both are index actions the
+    cascade is followed if either asked for it.
+
+    """
+    if old.action == 'index' and new.action == 'index' and old.cascade:
+        return new._replace(cascade=True)
+    return new
+
+def process_updates(updates):
+    """Make a list of updates.
+
+    Instances to be indexed are loaded with one query per model, and indexed
+    (along with their cascades) in a single batch.  Instances which no longer
+    exist are removed from the index.
+
+    """
+    by_model = {}
+    deletes = []
+    for update in updates:
+        if update.action == 'delete':
+            deletes.append(update)
+        else:
+            by_model.setdefault(update.model, []).append(update)
+
+    with batch():
+        for (typename, model_updates) in by_model.iteritems():
+            model = lookup_model(typename)
+            indexer = get_indexer(model)
+            if indexer is None:
+                continue
+            to_pk = model._meta.pk.to_python
+            instances = indexer.get_queryset().in_bulk(
+                [to_pk(update.object_pk) for update in model_updates])
+            for update in model_updates:
+                instance = instances.get(to_pk(update.object_pk))
+                if instance is None:
+                    deletes.append(update)
+                else:
+                    indexer.index_instance(instance,
+                                           with_cascade=update.cascade)
+
+    clients = []
+    for update in deletes:
+        indexer = get_indexer(lookup_model(update.model))
+        if indexer is None or not indexer.index:
+            continue
+        indexer.delete_documents([(update.doc_type, update.docid)])
+        if indexer.client not in clients:
+            clients.append(indexer.client)
+    for client in clients:
+        client.flush()
+
+class UpdateQueue(object):
+    """Base class for update queues.
+
+    """
+    # Whether updates may be queued within a managed transaction, and will
+    # only be made once it's committed.  If False, the hooks make such
+    # updates synchronously instead (see get_queue()).
+    transactional = True
+
+    def enqueue(self, update):
+        """Add an update to the queue.
+
+        """
+        raise NotImplementedError("Subclasses should implement this")
+
+    def drain(self, batch_size=500):
+        """Make all the updates in the queue, batch_size at a time.
+
+        Returns the number of updates made.
+
+        """
+        raise NotImplementedError("Subclasses should implement this")
+
+class ThreadQueue(UpdateQueue):
+    """A queue held in memory, and processed by a background thread.
+
+    """
+    # The thread would read the instances before the transaction commits.
+    transactional = False
+
+    def __init__(self, batch_size=500):
+        self.batch_size = batch_size
+        self._lock = threading.Lock()
+        self._process_lock = threading.Lock()
+        self._pending = {}
+        self._order = []
+        self._wakeup = threading.Event()
+        self._thread = None
+        atexit.register(self.drain)
+
+    def enqueue(self, update):
+        key = (update.model, update.object_pk)
+        self._lock.acquire()
+        try:
+            if key in self._pending:
+                update = merge_updates(self._pending[key], update)
+            else:
+                self._order.append(key)
+            self._pending[key] = update
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run)
+                self._thread.setDaemon(True)
+                self._thread.start()
+        finally:
+            self._lock.release()
+        self._wakeup.set()
+
+    def _take(self, batch_size):
+        self._lock.acquire()
+        try:
+            keys = self._order[:batch_size]
+            self._order = self._order[batch_size:]
+            return [self._pending.pop(key) for key in keys]
+        finally:
+            self._lock.release()
+
+    def drain(self, batch_size=None):
+        if batch_size is None:
+            batch_size = self.batch_size
+        count = 0
+        self._process_lock.acquire()
+        try:
+            while True:
+                updates = self._take(batch_size)
+                if not updates:
+                    return count
+                process_updates(updates)
+                count += len(updates)
+        finally:
+            self._process_lock.release()
+
+    def _run(self):
+        from django.db import connection
+        while True:
+            self._wakeup.wait()
+            self._wakeup.clear()
+            try:
+                self.drain()
+            except Exception:
+                print >>sys.stderr, "Error processing queued index updates:"
+                traceback.print_exc()
+            connection.close()
+
+class DatabaseQueue(UpdateQueue):
+    """A queue held in a database table.
+
+    """
+    def enqueue(self, update):
+        from models import QueuedUpdate
+        values = dict(action=update.action, doc_type=update.doc_type,
+                      docid=update.docid, queued_at=datetime.datetime.now())
+        if update.cascade:
+            values['cascade'] = True
+        existing = QueuedUpdate.objects.filter(model=update.model,
+                                               object_pk=update.object_pk)
+        if existing.update(**values):
+            return
+        sid = transaction.savepoint()
+        try:
+            QueuedUpdate.objects.create(model=update.model,
+                                        object_pk=update.object_pk,
+                                        **dict(values, cascade=update.cascade))
+            transaction.savepoint_commit(sid)
+        except IntegrityError:
+            # Someone else queued an update for the instance at the same time.
+            transaction.savepoint_rollback(sid)
+            existing.update(**values)
+
+    def drain(self, batch_size=500):
+        from models import QueuedUpdate
+        count = 0
+        while True:
+            rows = list(QueuedUpdate.objects.order_by('queued_at')[:batch_size])
+            if not rows:
+                return count
+            process_updates([Update(row.action, row.model, row.object_pk,
+                                    row.doc_type, row.docid, row.cascade)
+                             for row in rows])
+            # Only remove the entries which haven't been replaced by a newer
+            # update since we read them.
+            QueuedUpdate.objects.filter(reduce(operator.or_, [
+                Q(pk=row.pk, queued_at=row.queued_at) for row in rows
+            ])).delete()
+            count += len(rows)
+
+_queue = None
+def get_queue():
+    """Get the configured update queue, or None if updates aren't queued.
+
+    """
+    global _queue
+    if _queue is None:
+        name = getattr(settings, 'SEARCHIFY_QUEUE', None)
+        if name is None:
+            return None
+        if name == 'thread':
+            _queue = ThreadQueue()
+        elif name == 'database':
+            _queue = DatabaseQueue()
+        else:
+            try:
+                (module, classname) = name.rsplit('.', 1)
+                _queue = getattr(import_module(module), classname)()
+            except (ValueError, ImportError, AttributeError), e:
+                raise ImproperlyConfigured(
+                    "Could not load SEARCHIFY_QUEUE %r: %s" % (name, e))
+    return _queue
+
+def get_queue_for(using=None):
+    """Get the update queue to use for an instance being saved or deleted on
+    the database with alias using, or None if the update should be made
+    synchronously.
+
+    Queues which aren't transactional (see UpdateQueue) aren't used while a
+    transaction is being managed on the database.
+
+    """
+    queue = get_queue()
+    if queue is not None and not queue.transactional and \
+            transaction.is_managed(using=using):
+        return None
+    return queue
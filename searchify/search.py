@@ -1,169 +1,191 @@
 # search-specific pieces
 
+from utils import get_indexer
+
+class SearchResults(object):
+    """The results of a search, as model instances, fetched lazily.
+
+    Supports iteration, indexing, slicing and len().  Results are fetched a
+    page at a time; each page is larger than the last (up to max_page_size),
+    and while iterating, the search for the next page is started in the
+    background when fewer than prefetch_margin results of the current page
+    remain, if the searcher has an execute_async() method (which runs the
+    search on the client's pool of threads).  The instances for each page are
+    loaded with one query per model (see SearchResultSet.instances()).
+
+    len() gives the number of matching documents.  Results whose instances
+    have been deleted since they were indexed are skipped when iterating and
+    slicing, and are None when indexed individually.
+
+    Other attributes (eg: facets) are read from the result set of the most
+    recently fetched page.
+
+    """
+    initial_page_size = 10
+    max_page_size = 200
+    prefetch_margin = 5
+
+    def __init__(self, searcher, manager=None, select_related=None,
+                 only=None):
+        self.searcher = searcher
+        self.manager = manager
+        self.select_related = select_related
+        self.only = only
+        self.resultset = None
+        # Map from rank to instance (or None, if the instance doesn't exist).
+        self._instances = {}
+        self._count = None
+        self._page_size = self.initial_page_size
+        # (start, size, async result) for the search of the next page, if
+        # started in the background.
+        self._prefetch = None
+
+    def __repr__(self):
+        return "<SearchResults()>"
+
+    def __getattr__(self, key):
+        if key.startswith('_'):
+            raise AttributeError(key)
+        if self.resultset is None:
+            self._ensure(0, 1)
+        return getattr(self.resultset, key)
+
+    def _search(self, start, size):
+        return self.searcher.execute(start=start, size=size)
+
+    def _start_prefetch(self, start, size):
+        execute_async = getattr(self.searcher, 'execute_async', None)
+        if execute_async is not None:
+            self._prefetch = (start, size,
+                              execute_async(start=start, size=size))
+
+    def _fetch(self, start, size):
+        resultset = None
+        if self._prefetch is not None:
+            (prefetch_start, prefetch_size, result) = self._prefetch
+            self._prefetch = None
+            if prefetch_start == start and prefetch_size >= size:
+                # Raises the error if the background search failed.
+                resultset = result.get()
+        if resultset is None:
+            resultset = self._search(start, size)
+
+        self.resultset = resultset
+        self._count = resultset.count
+        instances = resultset.instances(select_related=self.select_related,
+                                        only=self.only, manager=self.manager)
+        by_hit = dict((id(instance.search_hit), instance)
+                      for instance in instances)
+        for (offset, result) in enumerate(resultset.results):
+            self._instances[start + offset] = by_hit.get(id(result.hit))
+
+    def _ensure(self, start, end):
+        """Ensure that the results with ranks from start up to end have been
+        fetched (as far as they exist).
+
+        """
+        if self._count is not None:
+            end = min(end, self._count)
+        while start < end and start in self._instances:
+            start += 1
+        while start < end and (end - 1) in self._instances:
+            end -= 1
+        if start >= end and self._count is not None:
+            return
+        self._fetch(start, max(end - start, self._page_size))
+        self._page_size = min(self._page_size * 2, self.max_page_size)
+
+    def __len__(self):
+        if self._count is None:
+            self._ensure(0, 1)
+        return self._count
+
+    def __iter__(self):
+        rank = 0
+        page_end = 0
+        while True:
+            if rank >= page_end:
+                self._ensure(rank, rank + 1)
+                page_end = rank
+                while page_end in self._instances:
+                    page_end += 1
+                if page_end == rank:
+                    return
+            if self._prefetch is None and \
+                    page_end - rank <= self.prefetch_margin and \
+                    page_end < self._count:
+                self._start_prefetch(page_end, self._page_size)
+            instance = self._instances[rank]
+            if instance is not None:
+                yield instance
+            rank += 1
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            if index.step is not None:
+                raise ValueError("Slicing search results with a step is not "
+                                 "supported")
+            (start, stop) = (index.start or 0, index.stop)
+            if start < 0 or (stop is not None and stop < 0) or stop is None:
+                (start, stop, _) = index.indices(len(self))
+            self._ensure(start, stop)
+            return [self._instances[rank] for rank in xrange(start, stop)
+                    if self._instances.get(rank) is not None]
+        if index < 0:
+            index += len(self)
+        self._ensure(index, index + 1)
+        try:
+            return self._instances[index]
+        except KeyError:
+            raise IndexError('search result index out of range')
+
+def msearch(searchers, **kwargs):
+    """Perform several searches, with a single request if the search engine
+    client supports it.
+
+    Each item of searchers is a searcher, or a (searcher, kwargs) pair giving
+    the keyword arguments to pass to its execute() method (eg: start and
+    size); otherwise, the keyword arguments passed to msearch() are used.
+    Returns a list of the result sets, in the same order.
+
+    """
+    searches = []
+    for item in searchers:
+        if isinstance(item, tuple):
+            searches.append(item)
+        else:
+            searches.append((item, kwargs))
+    if not searches:
+        return []
+    client = searches[0][0]._client
+    if hasattr(client, 'msearch'):
+        return client.msearch(searches)
+    return [searcher.execute(**search_kwargs)
+            for (searcher, search_kwargs) in searches]
+
 def make_searcher(manager, model):
-    index = get_index(model)
-    if not index:
+    """Make the query() method for a manager of a model.
+
+    query() returns a SearchResults for the instances of the model matching a
+    query string, loaded through the manager.  It requires a client whose
+    searchers support the SearchQS interface (eg: the pyes client).
+
+    """
+    indexer = get_indexer(model)
+    if indexer is None or not indexer.index:
         return None
 
-    client = get_client(index)
-    def search(query=None, start=None, end=None, query_filter=None):
-        if start==None and end==None:
-            # new-style interface. Return an object which responds to slicing and is iterable.
-            class SearchResultSet:
-                def __init__(self, query, query_filter=None):
-                    self.query = query
-                    self.query_filter = query_filter
-                    self.position = None
-                    self.smallest_page = 10
-                    # the following are filled out as needed
-                    self._results = None # just the current page of results (but contains useful metadata also)
-                    self.results = {} # store of index -> decorated Django instance
-
-                def __repr__(self):
-                    return "<SearchResultSet()>"
-
-                def __getattr__(self, key):
-                    # print "__getattr__(%s)" % key
-                    """Provide .-access to aspects of the result. eg: q.doc_count (providing the search provider returns doc_count)."""
-                    self._ensure_results()
-                    return getattr(self._results, key)
-                    
-                def _ensure_results(self, start=None, end=None):
-                    # print "_ensure_results(%s,%s)" % (start, end)
-                    """
-                    Call this before any operation to ensure that we've got some useful results available.
-                    If called with start=None, then ensure that the result at self.position is available.
-                    If not, ensure that the result at [start] or results at [start:end] are available.
-                    """
-                    if start==None:
-                        start=0
-                    if end==None:
-                        end=start+1
-                    # now reduce [start:end] to the single smallest range that we don't already have
-                    while self.results.has_key(start) and start < end:
-                        start += 1
-                    while self.results.has_key(end) and start < end:
-                        end -= 1
-                    if start==end:
-                        # we have everything we need already
-                        return
-                    if end-start < self.smallest_page:
-                        end = start + self.smallest_page
-                    
-                    self._results = client.search(self.query, self.query_filter, start, end)
-                    result_ids = []
-                    match_details = {}
-                    for item in self._results.results:
-                        search_id = item.docid
-                        database_name, model_key, django_id = search_id.split('.')
-                        if model_key != model.__name__:
-                            # FIXME: not right!
-                            # Either we need to get this right, or we could filter the query through a boolean to restrict to
-                            # this model in the first place. The latter would work better, but requires some thought. (In particular,
-                            # semi-constructing queries like this unsettles Richard, so there's probably a reason to avoid it.)
-                            #continue
-                            pass
-                        result_ids.append(long(django_id))
-                        match_details[django_id] = item
-                    bulk = manager.in_bulk(result_ids)
-
-                    for key, obj in bulk.items():
-                        # From Flax we get: data (dict of field->data pairs), id, rank
-                        # We only really care about rank at this stage, as we've pulled out the object.
-                        if hasattr(model.Searchable, 'match_details_attribute'):
-                            match_attr = model.Searchable.match_details_attribute
-                        else:
-                            match_attr = 'match'
-                        if match_attr is not None:
-                            setattr(obj, match_attr, match_details[str(obj.pk)])
-                        self.results[start] = obj
-                        start += 1
-                
-                def __iter__(self):
-                    return self
-                    
-                def next(self):
-                    # print "next()"
-                    self._ensure_results()
-                    ret = self[self.position]
-                    self.position += 1
-                    return ret
-                    
-                def __len__(self):
-                    # print "__len__()"
-                    self._ensure_results()
-                    # this is perhaps not the ideal solution, but should work in general
-                    return self.matches_upper_bound
-                    
-                def __getslice__(self, start, end):
-                    # print "__getslice__(%s, %s)" % (start, end)
-                    self._ensure_results(start, end)
-                    ret = []
-                    try:
-                        for idx in range(start, end):
-                            ret.append(self.results[idx])
-                    except KeyError:
-                        # Slices fail silently
-                        pass
-                    return ret
-                    
-                def __getitem__(self, index):
-                    # print "__getitem__(%s)" % index
-                    self._ensure_results(index)
-                    try:
-                        return self.results[index]
-                    except KeyError:
-                        # Indexing fails noisily
-                        raise IndexError('list index out of range')
-            
-            return SearchResultSet(query, query_filter)
-        else:
-            # old-style interface
-            if start==None:
-                start=0
-            if end==None:
-                end=10
-        class QueryResult:
-            def __init__(self, results):
-                self.results = results
-                search_ids = [ item.docid for item in results.results ]
-                self._result_ids = []
-                self._deets = {}
-                for item in results.results:
-                    search_id = item.docid
-                    database_name, model_key, id = search_id.split('.')
-                    if model_key != model.__name__:
-                        # FIXME: not right!
-                        pass
-                    self._result_ids.append(long(id))
-                    self._deets[id] = item
-                self._bulk = manager.in_bulk(self._result_ids)
-
-            # From Flax, we get: matches_lower_bound, matches_upper_bound, more_matches, matches_estimated, matches_human_readable_estimate
-            def __getattr__(self, key):
-                """Provide .-access to aspects of the result. eg: q.doc_count (providing the search provider returns doc_count)."""
-                return getattr(self.results, key)
-
-            def __len__(self):
-                return len(self._result_ids)
-            
-            def __iter__(self):
-                """
-                Iterate over the results, in the order they were in the result set.
-                Return a decorated object, ie the Django model instance with an extra attribute (default 'match') containing match details (you mostly care about .rank, if provided).
-                """
-                for key in self._result_ids:
-                    obj = self._bulk[long(key)]
-                    # From Flax we get: data (dict of field->data pairs), id, rank
-                    # We only really care about rank at this stage, as we've pulled out the object.
-                    if hasattr(model.Searchable, 'match_details_attribute'):
-                        match_attr = model.Searchable.match_details_attribute
-                    else:
-                        match_attr = 'match'
-                    if match_attr is not None:
-                        setattr(obj, match_attr, self._deets[str(obj.pk)])
-                    yield obj
-        
-        results = client.search(query, query_filter, start, end)
-        return QueryResult(results)
-    return search
+    def query(query_string=None, select_related=None, only=None, **kwargs):
+        """Search for instances of the model.
+
+        query_string is parsed as user input (with any further keyword
+        arguments passed to the parser); if it's None, all instances in the
+        index match.
+
+        """
+        searcher = indexer.get_searcher().for_type(indexer.get_typename(model))
+        if query_string is not None:
+            searcher = searcher.parse(query_string, **kwargs)
+        return SearchResults(searcher, manager, select_related=select_related,
+                             only=only)
+    return query
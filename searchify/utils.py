@@ -37,18 +37,32 @@ else:
     get_indexer = get_searcher = lambda x: None
 
 
+_model_cache = {}
 def lookup_model(modeldesc):
     """Convert a packed docid into a Model.
 
+    Models found are cached, since this is called for every search result.
+
     """
+    model = _model_cache.get(modeldesc)
+    if model is not None:
+        return model
     try:
         (app_label, model_name) = modeldesc.rsplit("|", 1)
-    except ValueError:
+    except (ValueError, AttributeError):
         return None
-    return models.get_model(app_label, model_name)
+    model = models.get_model(app_label, model_name)
+    if model is not None:
+        _model_cache[modeldesc] = model
+    return model
 
 
 def get_typename_from_object(instance):
+    opts = instance._meta
+    if getattr(instance, '_deferred', False):
+        # Instances loaded with only() or defer() are of a generated proxy
+        # class; use the model they were loaded from.
+        opts = opts.proxy_for_model._meta
     return '%s|%s' % (
-        instance._meta.app_label, instance._meta.object_name,
+        opts.app_label, opts.object_name,
     )